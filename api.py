@@ -0,0 +1,182 @@
+"""Read-only JSON API over users, posts and tags.
+
+    GET /api/v1/KIND?fields=a,b&include=rel&fields[rel]=c,d&after=ID&limit=N
+    GET /api/v1/KIND/ID?fields=...&include=...
+
+KIND is users, posts or tags. `fields` picks the columns returned (all by
+default) and `include` embeds related objects: a post's user and tags, a
+user's posts, a tag's posts. Lists are ordered by id and paged with the
+`after` cursor; each response ends with the `next_after` to pass for the
+next page, or null on the last one.
+
+Rows are read as plain column tuples, never ORM objects, in batches of
+API_BATCH_SIZE; related objects are fetched with one query per batch.
+Embedded lists hold at most API_INCLUDE_LIMIT objects per row, the ones
+with the lowest ids; compare with the owner's post_count to tell when a
+user's or tag's posts were cut short.
+List responses are streamed as they are serialized, so even a
+API_MAX_LIMIT-row page is never held in memory at once.
+"""
+import json
+from datetime import datetime
+
+from flask import Blueprint, Response, current_app, jsonify, request, stream_with_context
+from sqlalchemy import func, select
+
+from models import db, User, Post, PostTag, Tag
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+FIELDS = {
+    'users': {column.key: column for column in (
+        User.id, User.first_name, User.last_name, User.image_url, User.post_count, User.updated_at)},
+    'posts': {column.key: column for column in (
+        Post.id, Post.title, Post.content, Post.created_at, Post.updated_at, Post.user_id)},
+    'tags': {column.key: column for column in (
+        Tag.id, Tag.name, Tag.post_count, Tag.updated_at)},
+}
+
+# include name -> (related kind, to-many?, query for (owner id, *columns) given owner ids)
+INCLUDES = {
+    'users': {
+        'posts': ('posts', True, lambda columns, ids:
+                  select(Post.user_id, *columns).where(Post.user_id.in_(ids))),
+    },
+    'posts': {
+        'user': ('users', False, lambda columns, ids:
+                 select(Post.id, *columns).join(User, User.id == Post.user_id).where(Post.id.in_(ids))),
+        'tags': ('tags', True, lambda columns, ids:
+                 select(PostTag.post_id, *columns).join(Tag, Tag.id == PostTag.tag_id)
+                 .where(PostTag.post_id.in_(ids))),
+    },
+    'tags': {
+        'posts': ('posts', True, lambda columns, ids:
+                  select(PostTag.tag_id, *columns).join(Post, Post.id == PostTag.post_id)
+                  .where(PostTag.tag_id.in_(ids))),
+    },
+}
+
+KINDS = 'any(users, posts, tags)'
+
+
+class ApiError(ValueError):
+    """A malformed API request; answered with a 400 and the message."""
+
+
+@api.errorhandler(ApiError)
+def bad_request(error):
+    return jsonify(error=str(error)), 400
+
+
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _fields(kind, param):
+    """The field names requested by `param` for `kind`, all by default."""
+
+    names = request.args.get(param)
+    if not names:
+        return list(FIELDS[kind])
+    names = names.split(',')
+    unknown = [name for name in names if name not in FIELDS[kind]]
+    if unknown:
+        raise ApiError(f"Unknown {kind} fields: {', '.join(unknown)}")
+    return names
+
+
+def _includes(kind):
+    """(name, related kind, to-many?, query, fields) for each ?include=."""
+
+    names = [name for name in request.args.get('include', '').split(',') if name]
+    unknown = [name for name in names if name not in INCLUDES[kind]]
+    if unknown:
+        raise ApiError(f"Unknown {kind} includes: {', '.join(unknown)}")
+    return [(name, *INCLUDES[kind][name], _fields(INCLUDES[kind][name][0], f'fields[{name}]'))
+            for name in names]
+
+
+def _related(include, ids):
+    """{owner id: related object(s)} for one include over a batch of ids.
+    To-many includes stop at the first API_INCLUDE_LIMIT objects (by id)
+    per owner."""
+
+    name, kind, many, query, fields = include
+    columns = [FIELDS[kind][field] for field in fields]
+    query = query(columns, ids)
+    if many:
+        owner = query.selected_columns[0]
+        ranked = query.add_columns(
+            func.row_number().over(partition_by=owner, order_by=FIELDS[kind]['id']).label('position')
+        ).subquery()
+        query = (select(*list(ranked.c)[:-1])
+                 .where(ranked.c.position <= current_app.config['API_INCLUDE_LIMIT'])
+                 .order_by(ranked.c.position))
+    else:
+        query = query.order_by(FIELDS[kind]['id'])
+    related = {}
+    for owner_id, *values in db.session.execute(query):
+        item = dict(zip(fields, map(_value, values)))
+        if many:
+            related.setdefault(owner_id, []).append(item)
+        else:
+            related[owner_id] = item
+    return related
+
+
+def _rows(kind, fields, includes, *criteria, after=None, limit=None):
+    """Yield (id, serialized dict) for each matching row, in id order."""
+
+    id_column = FIELDS[kind]['id']
+    query = select(id_column, *(FIELDS[kind][field] for field in fields)).where(*criteria)
+    if after is not None:
+        query = query.where(id_column > after)
+    query = (query.order_by(id_column).limit(limit)
+             .execution_options(yield_per=current_app.config['API_BATCH_SIZE']))
+
+    for batch in db.session.execute(query).partitions():
+        ids = [row[0] for row in batch]
+        related = [(include[0], include[2], _related(include, ids)) for include in includes]
+        for row_id, *values in batch:
+            item = dict(zip(fields, map(_value, values)))
+            for name, many, objects in related:
+                item[name] = objects.get(row_id, [] if many else None)
+            yield row_id, item
+
+
+def _stream(rows, limit):
+    """The JSON list response, one row at a time."""
+
+    yield '{"data": ['
+    last_id, count = None, 0
+    for row_id, item in rows:
+        yield (',' if count else '') + json.dumps(item)
+        last_id, count = row_id, count + 1
+    next_after = last_id if count == limit else None
+    yield f'], "next_after": {json.dumps(next_after)}}}'
+
+
+@api.route(f'/<{KINDS}:kind>')
+def collection(kind):
+    """Stream one keyset page of KIND as JSON."""
+
+    try:
+        after = request.args.get('after', type=int)
+        limit = int(request.args.get('limit', current_app.config['PER_PAGE']))
+    except ValueError:
+        raise ApiError('limit must be an integer')
+    if not 1 <= limit <= current_app.config['API_MAX_LIMIT']:
+        raise ApiError(f"limit must be between 1 and {current_app.config['API_MAX_LIMIT']}")
+
+    # Parsed up front so bad parameters get a 400 before streaming starts.
+    rows = _rows(kind, _fields(kind, 'fields'), _includes(kind), after=after, limit=limit)
+    return Response(stream_with_context(_stream(rows, limit)), mimetype='application/json')
+
+
+@api.route(f'/<{KINDS}:kind>/<int:id>')
+def item(kind, id):
+    """One KIND row as JSON."""
+
+    for _, data in _rows(kind, _fields(kind, 'fields'), _includes(kind), FIELDS[kind]['id'] == id):
+        return jsonify(data=data)
+    return jsonify(error=f'No {kind[:-1]} {id}'), 404
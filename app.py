@@ -1,33 +1,139 @@
 """Blogly application."""
-
-from flask import Flask, render_template, request, redirect, flash, url_for
-from models import db, connect_db, User, Post, Tag
+import hashlib
+import os
+from collections import Counter
+from functools import wraps
+
+from flask import Flask, g, render_template, request, redirect, flash, url_for, jsonify, make_response
+from werkzeug.http import is_resource_modified
+from models import db, connect_db, touch, User, Post, Tag
+import queries
+import metrics
+import search
+import feed
+import links
+import routing
+from cache import cache
+from cli import blogly_cli
+from api import api
+from avatars import avatars
 
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///blogly'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'postgresql:///blogly')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
+app.config['REPLICA_DATABASE_URL'] = os.environ.get('REPLICA_DATABASE_URL')
+app.config['READ_YOUR_WRITES_SECONDS'] = 5
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+app.config['DB_POOL_TIMEOUT'] = 30
+app.config['DB_POOL_RECYCLE'] = 1800
+app.config['DB_POOL_PRE_PING'] = True
+app.config['DB_STATEMENT_TIMEOUT_MS'] = os.environ.get('DB_STATEMENT_TIMEOUT_MS')
 app.config['SECRET_KEY'] = 'akina123'  
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-
+app.config['MAX_QUERIES_PER_REQUEST'] = 10
+app.config['SLOW_QUERY_MS'] = None
+app.config['SLOW_QUERY_SAMPLE_RATE'] = 1.0
+app.config['PER_PAGE'] = 50
+app.config['CACHE_TYPE'] = 'lru'
+app.config['CACHE_MAX_ENTRIES'] = 1024
+app.config['CACHE_TTL'] = 300
+app.config['API_BATCH_SIZE'] = 1000
+app.config['API_MAX_LIMIT'] = 100_000
+app.config['API_INCLUDE_LIMIT'] = 100
+app.config['AVATAR_SIZES'] = (50, 300)
+app.config['AVATAR_DIR'] = os.environ.get('AVATAR_DIR', os.path.join(app.root_path, 'static', 'avatars'))
+app.config['AVATAR_WORKERS'] = 2
+app.config['AVATAR_FETCH_TIMEOUT'] = 10
+app.config['AVATAR_MAX_BYTES'] = 10 * 1024 * 1024
+app.config['AVATAR_MAX_PIXELS'] = 25_000_000
+app.config['AVATAR_FETCH_ALLOWED_NETWORKS'] = ()
+
+routing.configure(app)
 connect_db(app)
-
-with app.app_context():
-    db.create_all()
+routing.init_app(app, db)
+metrics.init_app(app, db)
+cache.init_app(app)
+app.cli.add_command(blogly_cli)
+app.register_blueprint(api)
+avatars.init_app(app)
+
+
+def page_args():
+    """Keyset cursor arguments (?after= / ?before=) for list views."""
+
+    return dict(after=request.args.get('after', type=int),
+                before=request.args.get('before', type=int),
+                per_page=app.config['PER_PAGE'])
+
+def conditional(version):
+    """Answer conditional GETs for a view before it runs.
+
+    `version` takes the view's arguments and returns the page's (ETag,
+    Last-Modified or None) from a single cheap query. When the client's copy is
+    still current the view is skipped and a 304 is returned, so no
+    relationships are loaded and no template is rendered.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            etag, last_modified = version(*args, **kwargs)
+            g.page_version = etag
+            if is_resource_modified(request.environ, etag, last_modified=last_modified):
+                response = make_response(view(*args, **kwargs))
+            else:
+                response = app.response_class(status=304)
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+@app.template_global()
+def tag_badges(post):
+    """Render a post's tag badges through the fragment cache."""
+
+    # Keyed by the tags shown, so a render from stale rows can't be served
+    # in place of a fresh one.
+    version = hashlib.sha1(repr([(tag.id, tag.name) for tag in post.tags]).encode()).hexdigest()
+    return cache.fragment(f'tag-badges:{post.id}:{version}',
+                          [f'post:{post.id}', *(f'tag:{tag.id}' for tag in post.tags)],
+                          lambda: render_template('tags/tag_badges.html', tags=post.tags))
+
+@app.route('/cache/stats')
+def cache_stats():
+    """Return the page cache hit/miss counters as JSON."""
+
+    return jsonify(cache.stats)
+
+@app.route('/db/pool')
+def pool_stats():
+    """Connection pool occupancy for the primary and any replica, as JSON."""
+
+    return jsonify(routing.pool_stats(db))
 
 @app.route('/')
+@conditional(lambda: queries.home_version(5))
+@cache.cached_page
 def root():
     """Show recent list of posts, most-recent first."""
 
-    posts = Post.query.order_by(Post.created_at.desc()).limit(5).all()
+    posts = queries.recent_feed(5)
+    cache.depends_on('home',
+                     *(f'post:{post.id}' for post in posts),
+                     *(f'user:{post.user_id}' for post in posts))
     return render_template("homepage.html", posts=posts)
 
 ############USERS################
 
 @app.route('/users')
 def users_list():
-    users = User.query.all()
+    """Show one page of users."""
+    users = queries.users_page(**page_args())
     return render_template('users/users.html', users=users)
 
 @app.route('/users/new', methods=["GET"])
@@ -46,37 +152,58 @@ def new_user():
 
         db.session.add(new_user)
         db.session.commit()
+        cache.invalidate(f'user:{new_user.id}')
+        avatars.ingest(new_user.id, image_url)
 
         return redirect('/users')
     
 @app.route('/users/<int:user_id>')
+@conditional(queries.user_version)
+@cache.cached_page
 def user_detail(user_id):
-    user = User.query.get_or_404(user_id)
+    user = queries.get_user_with_posts_or_404(user_id)
+    cache.depends_on(f'user:{user.id}', *(f'post:{post.id}' for post in user.posts))
     return render_template('users/user_details.html', user=user)
 
 @app.route('/users/<int:user_id>/edit')
 def edit_user(user_id):
-    user = User.query.get_or_404(user_id)
+    user = queries.get_user_or_404(user_id)
     return render_template('users/user_edit.html', user=user)
 
 @app.route('/users/<int:user_id>/edit', methods=['POST'])
 def update_user(user_id):
-    user = User.query.get_or_404(user_id)
+    user = queries.get_user_or_404(user_id)
+    old_image_url = user.image_url
+    old_name = (user.first_name, user.last_name)
     user.first_name = request.form.get('first_name')
     user.last_name = request.form.get('last_name')
     user.image_url = request.form.get('image_url', 'default_image.png')
     image_url = request.form.get('image_url')
     if image_url:
         user.image_url = image_url
-    
+    if user.image_url != old_image_url:
+        user.avatar_digest = None
+    if (user.first_name, user.last_name) != old_name:
+        feed.refresh_author(user)
+
     db.session.commit()
+    cache.invalidate(f'user:{user_id}')
+    if image_url != old_image_url:
+        avatars.ingest(user_id, image_url)
     return redirect(f'/users/{user_id}')
 
 @app.route('/users/<int:user_id>/delete', methods=['POST'])
 def delete_user(user_id):
-    user = User.query.get_or_404(user_id)
+    user = queries.get_user_for_delete_or_404(user_id)
+    post_ids = [post.id for post in user.posts]
+    tag_counts = Counter(tag.id for post in user.posts for tag in post.tags)
+    search.unindex_posts(post_ids)
+    feed.remove_posts(post_ids)
     db.session.delete(user)
+    db.session.flush()
+    feed.count_tag_posts({tag_id: -n for tag_id, n in tag_counts.items()})
     db.session.commit()
+    cache.invalidate('home', f'user:{user_id}', *(f'post:{post_id}' for post_id in post_ids))
     return redirect('/users')
 
 
@@ -84,84 +211,124 @@ def delete_user(user_id):
 
 @app.route('/users/<int:user_id>/posts/new', methods=['GET'])
 def posts_new_form(user_id):
-    user = User.query.get_or_404(user_id) 
+    user = queries.get_user_or_404(user_id) 
     return render_template('posts/post_new.html', user=user)  
 
 @app.route('/users/<int:user_id>/posts/new', methods=["POST"])
 def posts_new(user_id):
     """Handle form submission for creating a new post for a specific user"""
 
-    user = User.query.get_or_404(user_id)
+    user = queries.get_user_or_404(user_id)
     new_post = Post(title=request.form['title'],
                     content=request.form['content'],
                     user=user)
 
     db.session.add(new_post)
+    search.index_post(new_post)
+    feed.refresh_posts([new_post.id])
+    feed.count_user_posts({user_id: 1})
     db.session.commit()
+    cache.invalidate('home', f'user:{user_id}')
     flash(f"Post '{new_post.title}' added.")
 
     return redirect(f"/users/{user_id}")
 
 
 @app.route('/posts/<int:post_id>')
+@conditional(queries.post_version)
+@cache.cached_page
 def post_detail(post_id):
-    post = Post.query.get_or_404(post_id)
+    post = queries.get_post_with_details_or_404(post_id)
+    cache.depends_on(f'post:{post.id}', f'user:{post.user_id}')
     return render_template('posts/post_details.html', post=post)
 
 @app.route('/posts/<int:post_id>/edit', methods=['GET', 'POST'])
 def edit_post(post_id):
-    post = Post.query.get_or_404(post_id)
+    post = queries.get_post_or_404(post_id)
     if request.method == 'POST':
         post.title = request.form.get('title')
         post.content = request.form.get('content')
+        search.index_post(post)
+        feed.refresh_posts([post_id])
         db.session.commit()
+        cache.invalidate(f'post:{post_id}')
         return redirect(f'/posts/{post.id}')
     else:
         return render_template('posts/post_edit.html', post=post)
 
 @app.route('/posts/<int:post_id>/delete', methods=['POST'])
 def delete_post(post_id):
-    post = Post.query.get_or_404(post_id)
+    post = queries.get_post_with_details_or_404(post_id)
+    touch(post.user, *post.tags)
+    tag_ids = [tag.id for tag in post.tags]
+    search.unindex_posts([post_id])
+    feed.remove_posts([post_id])
     db.session.delete(post)
+    db.session.flush()
+    feed.count_user_posts({post.user_id: -1})
+    feed.count_tag_posts({tag_id: -1 for tag_id in tag_ids})
     db.session.commit()
+    cache.invalidate('home', f'post:{post_id}', f'user:{post.user_id}')
     return redirect(f'/users/{post.user_id}') 
 
+@app.route('/posts/lookup')
+def posts_lookup():
+    """Return one page of post ids and titles matching ?q= as JSON, for the
+    tag forms' type-ahead post picker."""
+
+    page = queries.post_titles_page(request.args.get('q'), **page_args())
+    return jsonify(posts=[{'id': post.id, 'title': post.title} for post in page],
+                   next_after=page.next_after)
+
+@app.route('/search')
+def search_posts():
+    """Show posts whose title or content match ?q=, best match first."""
+
+    q = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    results, has_next = search.search_posts(q, page, app.config['PER_PAGE'])
+    return render_template('posts/search.html', q=q, page=page,
+                           results=results, has_next=has_next)
+
 ############TAGS#############
 
 @app.route('/tags')
 def tags_index():
     """show page with all tags"""
-    tags = Tag.query.all()
+    tags = queries.tags_page(**page_args())
     return render_template('tags/tag_index.html', tags=tags)
 
 @app.route('/tags/new')
 def tags_new_form():
     """show form to create a new tag"""
-    posts = Post.query.all()
+    posts = queries.post_titles_page(per_page=app.config['PER_PAGE'])
     return render_template('/tags/tag_new.html', posts=posts)
 
 @app.route('/tags/new', methods=['POST'])
 def tags_new():
     """handles form submission for creating new tag"""
     tag_name = request.form.get('name')
-    post_ids = request.form.getlist('posts')
     new_tag = Tag(name=tag_name)
-
-    for post_id in post_ids:
-        post = Post.query.get(post_id)
-        new_tag.posts.append(post)
-
     db.session.add(new_tag)
+    db.session.flush()
+    tag_id = new_tag.id
+
+    added = links.tag_posts(tag_id, request.form.getlist('posts'))
+    changed = links.record_changes(added)
     db.session.commit()
+    cache.invalidate(f'tag:{tag_id}', *changed)
 
-    flash(f"Tag '{new_tag.name}' added.")
+    flash(f"Tag '{tag_name}' added.")
     return redirect('/tags')
 
 @app.route('/tags/<int:tag_id>')
+@conditional(queries.tag_version)
+@cache.cached_page
 def tags_show(tag_id):
     """show a page with info on a tag"""
 
-    tag = Tag.query.get_or_404(tag_id)
+    tag = queries.get_tag_with_posts_or_404(tag_id)
+    cache.depends_on(f'tag:{tag.id}', *(f'post:{post.id}' for post in tag.posts))
     return render_template('tags/tag_show.html', tag=tag)
 
 
@@ -169,31 +336,78 @@ def tags_show(tag_id):
 def tags_edit_form(tag_id):
     """show a form to edit an existing tag"""
 
-    tag = Tag.query.get_or_404(tag_id)
-    posts = Post.query.all()
-    return render_template('tags/tag_edit.html', tag=tag, posts=posts)
+    tag = queries.get_tag_or_404(tag_id)
+    tagged_posts = queries.tagged_post_titles_page(tag_id, **page_args())
+    posts = queries.post_titles_page(per_page=app.config['PER_PAGE'])
+    return render_template('tags/tag_edit.html', tag=tag, posts=posts,
+                           tagged_posts=tagged_posts,
+                           tagged_ids={post.id for post in tagged_posts},
+                           picker_name='add')
 
 @app.route('/tags/<int:tag_id>/edit', methods=["POST"])
 def tags_edit(tag_id):
-    """handle form submission for tag edits."""
-    tag = Tag.query.get_or_404(tag_id)
+    """handle form submission for tag edits.
+
+    The form lists one page of the tag's posts (`shown`), those left
+    checked (`keep`) and posts picked to add (`add`); only those changes
+    are applied, so tagged posts on other pages are left alone.
+    """
+    tag = queries.get_tag_or_404(tag_id)
+    old_name = tag.name
     tag.name = request.form['name']
-    post_ids = request.form.getlist('posts')
-    tag.posts = Post.query.filter(Post.id.in_(post_ids)).all()
-
-    db.session.add(tag)
+    db.session.flush()
+
+    unchecked = set(request.form.getlist('shown')) - set(request.form.getlist('keep'))
+    removed = links.untag_posts(tag_id, unchecked)
+    added = links.tag_posts(tag_id, request.form.getlist('add'))
+    changed = links.record_changes(added, removed)
+    if tag.name != old_name:
+        feed.rename_tag(tag_id, old_name, tag.name)
     db.session.commit()
-    flash(f"Tag '{tag.name}' edited.")
+    cache.invalidate(f'tag:{tag_id}', *changed)
+    flash(f"Tag '{request.form['name']}' edited.")
 
     return redirect("/tags")
 
+@app.route('/tags/links', methods=['POST'])
+def tags_links():
+    """Add and remove many post/tag links in one request.
+
+    Takes JSON {"add": [{"post_id": 1, "tag_id": 2}, ...], "remove": [...]};
+    removals run first, so a link in both lists ends up present. Returns how
+    many links were actually added and removed.
+    """
+
+    body = request.get_json(silent=True)
+    try:
+        add, remove = ({(int(link['post_id']), int(link['tag_id'])) for link in body.get(kind, [])}
+                       for kind in ('add', 'remove'))
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return jsonify(error='Expected {"add": [{"post_id", "tag_id"}], "remove": [...]}'), 400
+    missing = links.missing_ids(add)
+    if missing:
+        return jsonify(error='Unknown ids', **missing), 400
+
+    removed = links.remove_links(remove)
+    added = links.add_links(add)
+    changed = links.record_changes(added, removed)
+    db.session.commit()
+    cache.invalidate(*changed)
+    return jsonify(added=len(added), removed=len(removed))
+
 @app.route('/tags/<int:tag_id>/delete', methods=["POST"])
 def tags_delete(tag_id):
     """handle form submission for deleting a tag."""
-    tag = Tag.query.get_or_404(tag_id)
+    tag = queries.get_tag_with_posts_or_404(tag_id)
+    touch(*tag.posts)
+    post_ids = [post.id for post in tag.posts]
+    tag_name = tag.name
     db.session.delete(tag)
+    db.session.flush()
+    feed.refresh_posts(post_ids)
     db.session.commit()
-    flash(f"Tag '{tag.name}' deleted.")
+    cache.invalidate(f'tag:{tag_id}')
+    flash(f"Tag '{tag_name}' deleted.")
 
     return redirect('/tags')
 
@@ -0,0 +1,277 @@
+"""Local avatar thumbnails.
+
+When a user is saved with an http(s) image URL, a background worker
+fetches the image once, crops it square, resizes it to every
+AVATAR_SIZES width at 1x and 2x, and stores the results content-addressed
+by the sha256 of the source bytes. `User.avatar_digest` then points the
+templates at the local copies, served with immutable cache headers,
+instead of hotlinking the original. Until the worker finishes, or if the
+fetch fails or Pillow isn't installed, pages keep showing image_url.
+
+Fetches only ever connect to public addresses: every hop of a redirect
+chain is resolved and refused if it lands on a loopback, private,
+link-local or otherwise non-global address (unless that network is
+listed in AVATAR_FETCH_ALLOWED_NETWORKS), so image URLs can't be used to
+probe the internal network.
+
+Config:
+    AVATAR_SIZES          widths (px) the templates display avatars at
+    AVATAR_DIR            where LocalStore keeps thumbnails
+    AVATAR_WORKERS        background worker threads
+    AVATAR_FETCH_TIMEOUT  seconds to wait for the source image
+    AVATAR_MAX_BYTES      largest source image accepted
+    AVATAR_MAX_PIXELS     largest source image decoded (width * height)
+    AVATAR_FETCH_ALLOWED_NETWORKS
+                          non-public networks fetches may still reach
+"""
+import hashlib
+import http.client
+import io
+import ipaddress
+import logging
+import os
+import socket
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+
+from flask import send_from_directory, url_for
+from sqlalchemy import update
+
+from cache import cache
+from models import db, User
+
+log = logging.getLogger('blogly.avatars')
+
+YEAR = 365 * 24 * 60 * 60
+
+
+def _name(digest, width):
+    return f'{digest[:2]}/{digest}-{width}.jpg'
+
+
+class LocalStore:
+    """Thumbnails kept as files under `root`, served at /avatars/."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.root, name))
+
+    def save(self, name, data):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written aside and renamed so a reader never sees a partial file.
+        partial = f'{path}.{threading.get_ident()}.part'
+        with open(partial, 'wb') as file:
+            file.write(data)
+        os.replace(partial, path)
+
+    def url(self, name):
+        return url_for('avatar_file', name=name)
+
+
+############FETCHING################
+
+class BlockedAddress(ValueError):
+    """A fetch would have connected to a non-public address. (Not an
+    OSError, so urllib passes it through instead of wrapping it.)"""
+
+
+def _public_connector(allowed_networks):
+    """A socket.create_connection stand-in that resolves the host itself
+    and connects to the checked address, so a second DNS answer can't
+    swap in a private one."""
+
+    allowed = [ipaddress.ip_network(network) for network in allowed_networks]
+
+    def connect(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None, *args):
+        host, port = address
+        addresses = [info[4][0] for info in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)]
+        for ip in map(ipaddress.ip_address, addresses):
+            if not ip.is_global and not any(ip in network for network in allowed):
+                raise BlockedAddress(f'{host} resolves to non-public address {ip}')
+        return socket.create_connection((addresses[0], port), timeout, source_address)
+    return connect
+
+
+def _opener(allowed_networks):
+    """An opener for http(s) only, with no proxies, whose connections (on
+    every redirect hop) go through `_public_connector`."""
+
+    connect = _public_connector(allowed_networks)
+
+    class HTTPConnection(http.client.HTTPConnection):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self._create_connection = connect
+
+    class HTTPSConnection(http.client.HTTPSConnection):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self._create_connection = connect
+
+    class HTTPHandler(urllib.request.HTTPHandler):
+        def http_open(self, req):
+            return self.do_open(HTTPConnection, req)
+
+    class HTTPSHandler(urllib.request.HTTPSHandler):
+        def https_open(self, req):
+            return self.do_open(HTTPSConnection, req, context=self._context)
+
+    class RedirectHandler(urllib.request.HTTPRedirectHandler):
+        max_redirections = 3
+
+        def redirect_request(self, req, fp, code, msg, headers, newurl):
+            if urlparse(newurl).scheme not in ('http', 'https'):
+                raise BlockedAddress(f'redirect to {newurl}')
+            return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+    opener = urllib.request.OpenerDirector()
+    for handler in (HTTPHandler(), HTTPSHandler(), RedirectHandler(), urllib.request.UnknownHandler(),
+                    urllib.request.HTTPDefaultErrorHandler(), urllib.request.HTTPErrorProcessor()):
+        opener.add_handler(handler)
+    return opener
+
+
+def fetch(url, timeout, max_bytes, allowed_networks=()):
+    """The bytes at `url`, refusing anything over `max_bytes` and any
+    connection to a non-public address outside `allowed_networks`."""
+
+    request = urllib.request.Request(url, headers={'User-Agent': 'Blogly avatar fetcher'})
+    with _opener(allowed_networks).open(request, timeout=timeout) as response:
+        data = response.read(max_bytes + 1)
+    if len(data) > max_bytes:
+        raise ValueError(f'image is larger than {max_bytes} bytes')
+    return data
+
+
+############RESIZING################
+
+def thumbnails(data, widths, max_pixels):
+    """Square JPEG thumbnails of the image bytes `data`, by width. Images
+    over `max_pixels` are refused before anything is decoded."""
+
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        if image.width * image.height > max_pixels:
+            raise ValueError(f'image is {image.width}x{image.height}, over {max_pixels} pixels')
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        result = {}
+        for width in widths:
+            out = io.BytesIO()
+            ImageOps.fit(image, (width, width), Image.Resampling.LANCZOS).save(
+                out, 'JPEG', quality=85, optimize=True)
+            result[width] = out.getvalue()
+    return result
+
+
+class Avatars:
+    """Ingests avatars on a worker pool and renders their URLs."""
+
+    def __init__(self):
+        self.app = None
+        self.store = None
+        self.executor = None
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def init_app(self, app, store=None):
+        """Set up the store, worker pool, /avatars/ route and template
+        globals `avatar_url(user, width)` and `avatar_srcset(user, width)`."""
+
+        self.app = app
+        self.store = store or LocalStore(app.config['AVATAR_DIR'])
+        self.executor = ThreadPoolExecutor(app.config['AVATAR_WORKERS'],
+                                           thread_name_prefix='avatars')
+        app.add_url_rule('/avatars/<path:name>', 'avatar_file', self.serve)
+        app.add_template_global(self.url, 'avatar_url')
+        app.add_template_global(self.srcset, 'avatar_srcset')
+
+    @property
+    def widths(self):
+        return sorted({width * scale for width in self.app.config['AVATAR_SIZES'] for scale in (1, 2)})
+
+    def ingest(self, user_id, image_url):
+        """Queue fetching and resizing `image_url` for a user. Returns the
+        Future, or None when the URL isn't one to fetch."""
+
+        if urlparse(image_url or '').scheme not in ('http', 'https'):
+            return None
+        future = self.executor.submit(self._ingest, user_id, image_url)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def wait(self):
+        """Block until every queued avatar has been processed."""
+
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending)
+
+    def _ingest(self, user_id, image_url):
+        config = self.app.config
+        try:
+            data = fetch(image_url, config['AVATAR_FETCH_TIMEOUT'], config['AVATAR_MAX_BYTES'],
+                         config['AVATAR_FETCH_ALLOWED_NETWORKS'])
+            digest = hashlib.sha256(data).hexdigest()
+            if not all(self.store.exists(_name(digest, width)) for width in self.widths):
+                for width, thumbnail in thumbnails(data, self.widths, config['AVATAR_MAX_PIXELS']).items():
+                    self.store.save(_name(digest, width), thumbnail)
+        except ImportError:
+            log.warning('Pillow is not installed; avatars stay hotlinked')
+            return None
+        except (OSError, ValueError) as error:
+            log.warning('Could not ingest avatar %s for user %s: %s', image_url, user_id, error)
+            return None
+        except Exception:
+            # Anything else (e.g. Pillow's DecompressionBombError) would
+            # otherwise vanish inside the future.
+            log.exception('Could not ingest avatar %s for user %s', image_url, user_id)
+            return None
+
+        with self.app.app_context():
+            # Skipped if the user changed their image while this one was fetched.
+            updated = db.session.execute(
+                update(User)
+                .where(User.id == user_id, User.image_url == image_url)
+                .values(avatar_digest=digest)).rowcount
+            db.session.commit()
+            if updated:
+                cache.invalidate(f'user:{user_id}')
+        return digest
+
+    def serve(self, name):
+        """A stored thumbnail. Names are content hashes, so they never change."""
+
+        response = send_from_directory(self.store.root, name, max_age=YEAR)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    def url(self, user, width):
+        """src for `user`'s avatar displayed `width` px wide."""
+
+        if user.avatar_digest:
+            return self.store.url(_name(user.avatar_digest, width))
+        return user.image_url or url_for('static', filename='images/default_profile.png')
+
+    def srcset(self, user, width):
+        """srcset offering the 1x and 2x thumbnails, once they exist."""
+
+        if not user.avatar_digest:
+            return ''
+        return ', '.join(f'{self.store.url(_name(user.avatar_digest, width * scale))} {scale}x'
+                         for scale in (1, 2))
+
+
+avatars = Avatars()
@@ -0,0 +1,348 @@
+"""Load test every Blogly route against a seeded synthetic dataset.
+
+    python bench.py [--users N] [--posts-per-user N] [--tags N] [--tags-per-post N]
+                    [--requests N] [--traffic FILE] [--write-traffic FILE]
+                    [--url http://127.0.0.1:5000] [--concurrency N] [--no-cache]
+                    [--save-baseline FILE] [--baseline FILE] [--tolerance 0.25]
+
+The dataset is generated into DATABASE_URL (an in-memory SQLite database if
+unset) after DROPPING every Blogly table there, so point it at a scratch
+database. Traffic is a JSON Lines file of {"method", "path", "data"}
+requests; without --traffic a mix covering every route is generated.
+Requests go through the Flask test client, or over HTTP to a running
+server with --url (seed the server's database with --seed-only first).
+
+The report gives p50/p95/p99 latency, throughput and SQL statements per
+request for each route (read from the Server-Timing header). --save-baseline
+writes it as JSON; --baseline compares against a saved one and exits 1 if any
+route's p95 grew by more than --tolerance or it runs more queries.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import re
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///:memory:')
+
+from sqlalchemy import insert
+from app import app
+from cache import cache, NullCache
+from cli import _reset_sequence
+from models import db, User, Post, PostTag, Tag
+import search
+import feed
+
+BATCH = 5_000
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+         'incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud '
+         'exercitation ullamco laboris nisi aliquip ex ea commodo consequat').split()
+
+
+############DATA################
+
+class Dataset:
+    """Id ranges of a seeded dataset. Rows past `users`/`posts`/`tags` are
+    disposable: only the delete routes touch them, once each."""
+
+    def __init__(self, users, posts, tags, disposable):
+        self.users = users
+        self.posts = posts
+        self.tags = tags
+        self.disposable = disposable
+
+
+def _insert_batches(model, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH:
+            db.session.execute(insert(model), batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(model), batch)
+
+
+def seed(users=1_000, posts_per_user=10, tags=100, tags_per_post=3, disposable=100, rng=None):
+    """Drop and recreate the tables, then fill them with synthetic data."""
+
+    rng = rng or random.Random(0)
+    db.drop_all()
+    db.create_all()
+    total_users = users + disposable
+    total_posts = users * posts_per_user + disposable
+    total_tags = tags + disposable
+    start = datetime(2024, 1, 1)
+
+    _insert_batches(User, ({'id': i, 'first_name': f'First{i}', 'last_name': f'Last{i}'}
+                           for i in range(1, total_users + 1)))
+    _insert_batches(Tag, ({'id': i, 'name': f'tag{i}'} for i in range(1, total_tags + 1)))
+
+    def posts():
+        for i in range(1, total_posts + 1):
+            # Disposable users get no posts; disposable posts go to regular users.
+            user_id = ((i - 1) // posts_per_user + 1 if i <= users * posts_per_user
+                       else (i - 1) % users + 1)
+            yield {'id': i, 'user_id': user_id,
+                   'title': ' '.join(rng.choices(WORDS, k=5)),
+                   'content': ' '.join(rng.choices(WORDS, k=40)),
+                   'created_at': start + timedelta(minutes=i)}
+    _insert_batches(Post, posts())
+
+    _insert_batches(PostTag, ({'post_id': post_id, 'tag_id': tag_id}
+                              for post_id in range(1, total_posts + 1)
+                              for tag_id in rng.sample(range(1, tags + 1), min(tags_per_post, tags))))
+    search.rebuild_index()
+    feed.verify()
+    for table in ('users', 'posts', 'tags'):
+        _reset_sequence(table)
+    db.session.commit()
+    return Dataset(users, users * posts_per_user, tags, disposable)
+
+
+############TRAFFIC################
+
+def generate_traffic(data, count, rng=None):
+    """A request mix hitting every route, weighted towards the read pages."""
+
+    rng = rng or random.Random(1)
+    user = lambda: rng.randint(1, data.users)
+    post = lambda: rng.randint(1, data.posts)
+    tag = lambda: rng.randint(1, data.tags)
+    word = lambda: rng.choice(WORDS)
+    deletes = {'user': iter(range(data.users + 1, data.users + data.disposable + 1)),
+               'post': iter(range(data.posts + 1, data.posts + data.disposable + 1)),
+               'tag': iter(range(data.tags + 1, data.tags + data.disposable + 1))}
+    created = iter(range(1, count + 1))
+
+    mix = [
+        (20, lambda: ('GET', '/', None)),
+        (4, lambda: ('GET', '/users', None)),
+        (2, lambda: ('GET', f'/users?after={user()}', None)),
+        (10, lambda: ('GET', f'/users/{user()}', None)),
+        (1, lambda: ('GET', '/users/new', None)),
+        (1, lambda: ('GET', f'/users/{user()}/edit', None)),
+        (1, lambda: ('GET', f'/users/{user()}/posts/new', None)),
+        (25, lambda: ('GET', f'/posts/{post()}', None)),
+        (2, lambda: ('GET', f'/posts/{post()}/edit', None)),
+        (3, lambda: ('GET', f'/posts/lookup?q={word()}', None)),
+        (5, lambda: ('GET', f'/search?q={word()}', None)),
+        (3, lambda: ('GET', '/tags', None)),
+        (1, lambda: ('GET', '/tags/new', None)),
+        (8, lambda: ('GET', f'/tags/{tag()}', None)),
+        (2, lambda: ('GET', f'/tags/{tag()}/edit', None)),
+        (1, lambda: ('POST', '/users/new',
+                     {'first_name': 'Bench', 'last_name': f'User{next(created)}'})),
+        (1, lambda: ('POST', f'/users/{user()}/edit',
+                     {'first_name': 'Edited', 'last_name': 'User'})),
+        (1, lambda: ('POST', f'/users/{user()}/posts/new',
+                     {'title': f'New post {word()}', 'content': ' '.join(rng.choices(WORDS, k=40))})),
+        (1, lambda: ('POST', f'/posts/{post()}/edit',
+                     {'title': f'Edited {word()}', 'content': ' '.join(rng.choices(WORDS, k=40))})),
+        (1, lambda: ('POST', '/tags/new',
+                     {'name': f'bench-tag-{next(created)}', 'posts': [post() for _ in range(3)]})),
+        (1, lambda: ('POST', f'/tags/{tag()}/edit',
+                     {'name': f'tag-edited-{next(created)}', 'add': [post() for _ in range(3)]})),
+        (0.5, lambda: ('POST', f"/users/{next(deletes['user'])}/delete", None)),
+        (0.5, lambda: ('POST', f"/posts/{next(deletes['post'])}/delete", None)),
+        (0.5, lambda: ('POST', f"/tags/{next(deletes['tag'])}/delete", None)),
+    ]
+    weights = [weight for weight, _ in mix]
+    traffic = []
+    while len(traffic) < count:
+        make = rng.choices(mix, weights)[0][1]
+        try:
+            method, path, data_ = make()
+        except StopIteration:
+            continue  # out of disposable rows for this delete route
+        traffic.append({'method': method, 'path': path, 'data': data_})
+    return traffic
+
+
+def read_traffic(path):
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+############DRIVER################
+
+SERVER_TIMING_QUERIES = re.compile(r'desc="(\d+) queries"')
+
+
+def route_of(method, path):
+    """The Flask endpoint a request is routed to, used as its report label."""
+
+    adapter = app.url_map.bind('localhost')
+    try:
+        return adapter.match(urllib.parse.urlsplit(path).path, method)[0]
+    except Exception:
+        return 'unmatched'
+
+
+def _queries(headers):
+    match = SERVER_TIMING_QUERIES.search(headers.get('Server-Timing', ''))
+    return int(match.group(1)) if match else 0
+
+
+def _send_test_client(client, request):
+    start = time.perf_counter()
+    response = client.open(request['path'], method=request['method'], data=request.get('data'))
+    elapsed = time.perf_counter() - start
+    return elapsed, response.status_code, _queries(response.headers)
+
+
+def _send_http(url, request):
+    data = request.get('data')
+    body = urllib.parse.urlencode(data, doseq=True).encode() if data is not None else None
+    req = urllib.request.Request(url + request['path'], data=body, method=request['method'])
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req) as response:
+            response.read()
+            status, headers = response.status, response.headers
+    except urllib.error.HTTPError as error:
+        status, headers = error.code, error.headers
+    return time.perf_counter() - start, status, _queries(headers)
+
+
+def run(traffic, url=None, concurrency=1):
+    """Send every request and return one (route, seconds, status, queries)
+    sample per request, plus the wall-clock time taken."""
+
+    if url:
+        send = lambda request: _send_http(url.rstrip('/'), request)
+    else:
+        # The test client shares one database connection: keep it serial.
+        client = app.test_client()
+        send = lambda request: _send_test_client(client, request)
+        concurrency = 1
+
+    def sample(request):
+        elapsed, status, queries = send(request)
+        return route_of(request['method'], request['path']), elapsed, status, queries
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as pool:
+            samples = list(pool.map(sample, traffic))
+    else:
+        samples = [sample(request) for request in traffic]
+    return samples, time.perf_counter() - start
+
+
+############REPORT################
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a sorted list."""
+
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def summarize(samples, wall_time):
+    """Per-route latency percentiles (ms), throughput and queries/request."""
+
+    by_route = {}
+    for route, elapsed, status, queries in samples:
+        by_route.setdefault(route, []).append((elapsed, status, queries))
+    routes = {}
+    for route, rows in sorted(by_route.items()):
+        latencies = sorted(elapsed * 1000 for elapsed, _, _ in rows)
+        routes[route] = {
+            'count': len(rows),
+            'p50_ms': percentile(latencies, 0.50),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+            'queries_per_request': sum(queries for _, _, queries in rows) / len(rows),
+            'errors': sum(1 for _, status, _ in rows if status >= 500),
+        }
+    return {'requests': len(samples),
+            'throughput_rps': len(samples) / wall_time if wall_time else 0.0,
+            'routes': routes}
+
+
+def print_report(report, out=sys.stdout):
+    print(f"{'route':<18} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'queries':>8} {'5xx':>4}", file=out)
+    for route, stats in report['routes'].items():
+        print(f"{route:<18} {stats['count']:>6} {stats['p50_ms']:>8.2f} {stats['p95_ms']:>8.2f} "
+              f"{stats['p99_ms']:>8.2f} {stats['queries_per_request']:>8.2f} {stats['errors']:>4}",
+              file=out)
+    print(f"{report['requests']} requests, {report['throughput_rps']:.1f} req/s", file=out)
+
+
+def regressions(report, baseline, tolerance=0.25):
+    """Describe every route that got slower or chattier than the baseline."""
+
+    problems = []
+    for route, old in baseline['routes'].items():
+        new = report['routes'].get(route)
+        if new is None:
+            continue
+        if new['p95_ms'] > old['p95_ms'] * (1 + tolerance):
+            problems.append(f"{route}: p95 {old['p95_ms']:.2f} -> {new['p95_ms']:.2f} ms")
+        if new['queries_per_request'] > old['queries_per_request'] + 1e-9:
+            problems.append(f"{route}: queries/request {old['queries_per_request']:.2f} -> "
+                            f"{new['queries_per_request']:.2f}")
+        if new['errors'] > old['errors']:
+            problems.append(f"{route}: {new['errors']} server errors")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1_000)
+    parser.add_argument('--posts-per-user', type=int, default=10)
+    parser.add_argument('--tags', type=int, default=100)
+    parser.add_argument('--tags-per-post', type=int, default=3)
+    parser.add_argument('--requests', type=int, default=2_000)
+    parser.add_argument('--traffic', help='replay this JSON Lines traffic file')
+    parser.add_argument('--write-traffic', help='save the generated traffic here')
+    parser.add_argument('--url', help='send requests to this running server')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--seed-only', action='store_true')
+    parser.add_argument('--no-cache', action='store_true', help='disable the page cache')
+    parser.add_argument('--save-baseline')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    with app.app_context():
+        # Enough throwaway rows for the delete routes in the generated mix.
+        disposable = 0 if args.traffic else max(10, args.requests // 50)
+        data = seed(args.users, args.posts_per_user, args.tags, args.tags_per_post, disposable)
+        if args.seed_only:
+            return 0
+        traffic = read_traffic(args.traffic) if args.traffic else generate_traffic(data, args.requests)
+        if args.write_traffic:
+            with open(args.write_traffic, 'w') as file:
+                file.writelines(json.dumps(request) + '\n' for request in traffic)
+        if args.no_cache:
+            cache.backend = NullCache()
+        cache.clear()
+
+    samples, wall_time = run(traffic, args.url, args.concurrency)
+    report = summarize(samples, wall_time)
+    print_report(report)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            problems = regressions(report, json.load(file), args.tolerance)
+        for problem in problems:
+            print(f'REGRESSION {problem}', file=sys.stderr)
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
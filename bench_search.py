@@ -0,0 +1,73 @@
+"""Benchmark /search latency against corpus size.
+
+    python bench_search.py [SIZE ...]
+
+Seeds SIZE random posts for each size (default 1k, 10k, 100k) into the
+database named by DATABASE_URL (an in-memory SQLite database if unset),
+builds the search index and times a batch of searches.
+"""
+import os
+import random
+import statistics
+import sys
+import time
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///:memory:')
+
+from sqlalchemy import insert
+from app import app
+from models import db, User, Post
+import search
+
+SIZES = [1_000, 10_000, 100_000]
+QUERIES = 200
+BATCH = 5_000
+
+random.seed(0)
+WORDS = [''.join(random.choices('abcdefghijklmnopqrstuvwxyz', k=random.randint(3, 9)))
+         for _ in range(5_000)]
+
+
+def sentence(count):
+    return ' '.join(random.choices(WORDS, k=count))
+
+
+def seed(size):
+    db.drop_all()
+    db.create_all()
+    user = User(first_name='Bench', last_name='User')
+    db.session.add(user)
+    db.session.flush()
+    for start in range(0, size, BATCH):
+        db.session.execute(insert(Post), [
+            {'title': sentence(5), 'content': sentence(60), 'user_id': user.id}
+            for _ in range(min(BATCH, size - start))
+        ])
+    search.rebuild_index()
+    db.session.commit()
+
+
+def time_searches(client):
+    timings = []
+    for _ in range(QUERIES):
+        q = ' '.join(random.choices(WORDS, k=random.randint(1, 2)))
+        start = time.perf_counter()
+        response = client.get('/search', query_string={'q': q})
+        timings.append((time.perf_counter() - start) * 1000)
+        assert response.status_code == 200
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95)]
+
+
+def main(sizes):
+    client = app.test_client()
+    print(f"{'posts':>10} {'p50 ms':>8} {'p95 ms':>8}")
+    with app.app_context():
+        for size in sizes:
+            seed(size)
+            p50, p95 = time_searches(client)
+            print(f"{size:>10} {p50:>8.2f} {p95:>8.2f}")
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
@@ -0,0 +1,232 @@
+"""Rendered page and fragment cache for Blogly.
+
+Cached entries remember which rows they were built from as dependency
+strings such as 'post:3', 'user:1', 'tag:2' or 'home'. Write routes call
+`cache.invalidate(...)` with the rows they changed, which drops exactly
+the entries built from them.
+"""
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import g, request
+from markupsafe import Markup
+
+
+class NullCache:
+    """Backend that stores nothing (CACHE_TYPE = 'null')."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, deps=()):
+        pass
+
+    def invalidate(self, deps):
+        return 0
+
+    def clear(self):
+        pass
+
+
+class LRUCache:
+    """In-process backend holding at most `max_entries` values, each for at
+    most `ttl` seconds, evicting the least recently used first."""
+
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._dependents = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value, deps = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, deps=()):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            deps = frozenset(deps)
+            self._entries[key] = (time.monotonic() + self.ttl, value, deps)
+            for dep in deps:
+                self._dependents.setdefault(dep, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, deps):
+        with self._lock:
+            keys = set()
+            for dep in deps:
+                keys |= self._dependents.pop(dep, set())
+            removed = 0
+            for key in keys:
+                if key in self._entries:
+                    self._remove(key)
+                    removed += 1
+            return removed
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._dependents.clear()
+
+    def _remove(self, key):
+        _, _, deps = self._entries.pop(key)
+        for dep in deps:
+            keys = self._dependents.get(dep)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._dependents[dep]
+
+
+class RedisCache:
+    """Backend on top of a redis-py compatible client (Redis itself, or a
+    local stand-in such as KeyDB, Dragonfly or fakeredis).
+
+    Each dependency is kept as a Redis set of the keys built from it.
+    Values are rendered HTML and are stored as plain UTF-8 strings, never
+    pickled, so reading the cache can't run code planted in it.
+    """
+
+    def __init__(self, client, ttl=300, prefix='blogly:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        import redis
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return value.decode() if isinstance(value, bytes) else value
+
+    def set(self, key, value, deps=()):
+        pipe = self.client.pipeline()
+        pipe.set(self.prefix + key, str(value), ex=self.ttl)
+        for dep in deps:
+            dep_key = f'{self.prefix}dep:{dep}'
+            pipe.sadd(dep_key, key)
+            pipe.expire(dep_key, self.ttl)
+        pipe.execute()
+
+    def invalidate(self, deps):
+        keys = set()
+        for dep in deps:
+            keys |= {key.decode() if isinstance(key, bytes) else key
+                     for key in self.client.smembers(f'{self.prefix}dep:{dep}')}
+        pipe = self.client.pipeline()
+        for key in keys:
+            pipe.delete(self.prefix + key)
+        for dep in deps:
+            pipe.delete(f'{self.prefix}dep:{dep}')
+        removed = pipe.execute()
+        return sum(removed[:len(keys)])
+
+    def clear(self):
+        keys = list(self.client.scan_iter(f'{self.prefix}*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+class Cache:
+    """Page and fragment cache with hit/miss counters.
+
+    The backend is picked from app config by `init_app`:
+    CACHE_TYPE ('lru', 'redis' or 'null'), CACHE_MAX_ENTRIES, CACHE_TTL and
+    CACHE_REDIS_URL.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or NullCache()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def init_app(self, app):
+        cache_type = app.config.get('CACHE_TYPE', 'lru')
+        ttl = app.config.get('CACHE_TTL', 300)
+        if cache_type == 'lru':
+            self.backend = LRUCache(app.config.get('CACHE_MAX_ENTRIES', 1024), ttl)
+        elif cache_type == 'redis':
+            self.backend = RedisCache.from_url(app.config['CACHE_REDIS_URL'], ttl=ttl)
+        elif cache_type == 'null':
+            self.backend = NullCache()
+        else:
+            raise ValueError(f'Unknown CACHE_TYPE {cache_type!r}')
+
+    def get(self, key):
+        value = self.backend.get(key)
+        self.stats['hits' if value is not None else 'misses'] += 1
+        return value
+
+    def set(self, key, value, deps=()):
+        self.backend.set(key, value, deps)
+
+    def invalidate(self, *deps):
+        """Drop every entry built from any of `deps`."""
+
+        self.stats['invalidations'] += self.backend.invalidate(deps)
+
+    def clear(self):
+        self.backend.clear()
+        self.stats = dict.fromkeys(self.stats, 0)
+
+    def depends_on(self, *deps):
+        """Record that the page being rendered is built from `deps`."""
+
+        page_deps = g.get('cache_deps')
+        if page_deps is not None:
+            page_deps.update(deps)
+
+    def cached_page(self, view):
+        """Cache the HTML a GET view returns, keyed by path and query string,
+        plus the page's ETag when an outer `conditional` has computed one
+        (`g.page_version`).
+
+        The view calls `depends_on` with the rows it shows so the page is
+        dropped when any of them is written. The version in the key means a
+        page rendered from rows that were already stale (say, read from a
+        lagging replica after the writer invalidated it) is only ever served
+        to readers who see those same stale rows.
+        """
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = f'page:{request.full_path}'
+            if g.get('page_version'):
+                key += f'@{g.page_version}'
+            body = self.get(key)
+            if body is not None:
+                return body
+            g.cache_deps = set()
+            rv = view(*args, **kwargs)
+            if isinstance(rv, str):
+                self.set(key, rv, g.cache_deps)
+            return rv
+        return wrapper
+
+    def fragment(self, key, deps, render):
+        """Return the cached HTML for `key`, calling `render()` to build and
+        store it on a miss. `deps` also count towards the enclosing page."""
+
+        self.depends_on(*deps)
+        body = self.get(f'fragment:{key}')
+        if body is None:
+            body = render()
+            self.set(f'fragment:{key}', body, deps)
+        return Markup(body)
+
+
+cache = Cache()
@@ -0,0 +1,234 @@
+"""Bulk import/export commands.
+
+    flask blogly export KIND [-o FILE]
+    flask blogly import KIND FILE
+    flask blogly verify-feed [--dry-run]
+
+KIND is users, posts, tags or links (post/tag pairs). Files are JSON Lines
+or CSV, picked by extension. Both directions stream in batches, so memory
+stays flat however big the tables are. Imports commit once per batch and
+skip rows that already exist (by id for users and posts, by name for tags,
+by pair for links), so an interrupted import can simply be re-run. User
+and post records must therefore carry an id; one without is refused.
+Imported posts and links are added to the homepage feed and post counts.
+
+These commands run in their own process, so they can't reach the web
+workers' in-process caches. They don't need to: cached pages are keyed
+by their ETag, and every write here moves the rows that ETag is built
+from (updated_at, post counts, feed rows), so workers simply miss and
+re-render. Entries for the old versions age out with CACHE_TTL.
+"""
+import csv
+import json
+import sys
+from collections import Counter
+from datetime import datetime
+from itertools import islice
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import select, text
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, User, Post, PostTag, Tag
+import search
+import feed
+import links
+
+blogly_cli = AppGroup('blogly', help='Bulk import and export Blogly data.')
+
+KINDS = {
+    'users': (User.id, User.first_name, User.last_name, User.image_url),
+    'posts': (Post.id, Post.title, Post.content, Post.created_at, Post.user_id),
+    'tags': (Tag.id, Tag.name),
+    'links': (PostTag.post_id, Tag.name.label('tag')),
+}
+
+
+def _format(path, format):
+    if format:
+        return format
+    return 'csv' if path and path.endswith('.csv') else 'jsonl'
+
+
+def _batches(rows, size):
+    rows = iter(rows)
+    while batch := list(islice(rows, size)):
+        yield batch
+
+
+############EXPORT################
+
+def _serialize(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+@blogly_cli.command('export')
+@click.argument('kind', type=click.Choice(list(KINDS)))
+@click.option('-o', '--output', type=click.Path(dir_okay=False), help='File to write (default stdout).')
+@click.option('--format', type=click.Choice(['jsonl', 'csv']), help='Default: from the file extension.')
+@click.option('--batch-size', default=10_000, show_default=True)
+def export_command(kind, output, format, batch_size):
+    """Stream every KIND row to a file."""
+
+    columns = KINDS[kind]
+    query = select(*columns)
+    if kind == 'links':
+        query = query.join(Tag, Tag.id == PostTag.tag_id)
+    query = query.order_by(columns[0]).execution_options(yield_per=batch_size)
+    rows = db.session.execute(query)
+
+    out = open(output, 'w', newline='') if output else sys.stdout
+    try:
+        if _format(output, format) == 'csv':
+            writer = csv.writer(out)
+            writer.writerow(rows.keys())
+            for row in rows:
+                writer.writerow([_serialize(value) for value in row])
+        else:
+            for row in rows:
+                out.write(json.dumps({key: _serialize(value)
+                                      for key, value in row._mapping.items()}) + '\n')
+    finally:
+        if output:
+            out.close()
+
+
+############IMPORT################
+
+def _read(file, format):
+    """Yield (line number, record) for each record of `file`, the record as
+    a dict of column name to value."""
+
+    if format == 'csv':
+        reader = csv.DictReader(file)
+        for record in reader:
+            yield reader.line_num, {key: value if value != '' else None for key, value in record.items()}
+    else:
+        for number, line in enumerate(file, 1):
+            if line.strip():
+                yield number, json.loads(line)
+
+
+def _records(kind, rows):
+    """The records of `rows`, refusing users and posts without an id: a
+    re-run only recognises those by id, so it would insert them again."""
+
+    for line, record in rows:
+        if kind in ('users', 'posts') and record.get('id') is None:
+            raise click.ClickException(
+                f'{kind} line {line}: missing id (needed so a re-run skips rows already imported)')
+        yield record
+
+
+def _insert_rows(model, key, rows):
+    """Insert `rows` in one executemany per shape, skipping rows whose `key`
+    column already exists. Returns the ids actually inserted."""
+
+    shapes = {}
+    for row in rows:
+        row = {column: value for column, value in row.items() if value is not None}
+        shapes.setdefault(frozenset(row), []).append(row)
+    dialect = db.session.get_bind().dialect.name
+    insert = (postgresql if dialect == 'postgresql' else sqlite).insert
+    inserted = []
+    for shape in shapes.values():
+        inserted += db.session.execute(
+            insert(model).on_conflict_do_nothing(index_elements=[key]).returning(model.id),
+            shape).scalars().all()
+    return inserted
+
+
+def _int(value):
+    return None if value is None else int(value)
+
+
+def _import_users(batch):
+    return len(_insert_rows(User, 'id', [
+        {'id': _int(record.get('id')), 'first_name': record['first_name'],
+         'last_name': record['last_name'], 'image_url': record.get('image_url')}
+        for record in batch]))
+
+
+def _import_posts(batch):
+    post_ids = _insert_rows(Post, 'id', [
+        {'id': _int(record.get('id')), 'title': record['title'],
+         'content': record['content'], 'user_id': int(record['user_id']),
+         'created_at': record.get('created_at') and datetime.fromisoformat(record['created_at'])}
+        for record in batch])
+    search.index_posts(post_ids)
+    feed.refresh_posts(post_ids)
+    if post_ids:
+        feed.count_user_posts(Counter(db.session.execute(
+            select(Post.user_id).where(Post.id.in_(post_ids))).scalars()))
+    return len(post_ids)
+
+
+def _import_tags(batch):
+    return len(_insert_rows(Tag, 'name', [{'name': record['name']} for record in batch]))
+
+
+def _import_links(batch):
+    names = {record['tag'] for record in batch}
+    tag_ids = dict(db.session.execute(
+        select(Tag.name, Tag.id).where(Tag.name.in_(names))).all())
+    missing = names - tag_ids.keys()
+    if missing:
+        raise click.ClickException(f"Unknown tags: {', '.join(sorted(missing))}")
+    added = links.add_links((int(record['post_id']), tag_ids[record['tag']]) for record in batch)
+    links.record_changes(added)
+    return len(added)
+
+
+IMPORTERS = {
+    'users': _import_users,
+    'posts': _import_posts,
+    'tags': _import_tags,
+    'links': _import_links,
+}
+
+
+def _reset_sequence(table):
+    """Move a Postgres id sequence past ids that were inserted explicitly."""
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        db.session.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"COALESCE((SELECT MAX(id) FROM {table}), 1))"))
+
+
+@blogly_cli.command('import')
+@click.argument('kind', type=click.Choice(list(KINDS)))
+@click.argument('file', type=click.File('r'))
+@click.option('--format', type=click.Choice(['jsonl', 'csv']), help='Default: from the file extension.')
+@click.option('--batch-size', default=10_000, show_default=True)
+def import_command(kind, file, format, batch_size):
+    """Load KIND rows from FILE ('-' for stdin), skipping ones already present.
+
+    Import users, then posts, then tags, then links.
+    """
+
+    importer = IMPORTERS[kind]
+    inserted = total = 0
+    records = _records(kind, _read(file, _format(file.name, format)))
+    for batch in _batches(records, batch_size):
+        inserted += importer(batch)
+        total += len(batch)
+        db.session.commit()
+        click.echo(f'{kind}: {total} read, {inserted} inserted', err=True)
+    if kind in ('users', 'posts', 'tags'):
+        _reset_sequence(kind)
+        db.session.commit()
+
+
+############VERIFY################
+
+@blogly_cli.command('verify-feed')
+@click.option('--dry-run', is_flag=True, help='Report drift without repairing it.')
+@click.option('--batch-size', default=10_000, show_default=True)
+def verify_feed_command(dry_run, batch_size):
+    """Check post counts and the homepage feed against the source tables."""
+
+    drift = feed.verify(batch_size=batch_size, repair=not dry_run)
+    for kind, count in drift.items():
+        click.echo(f'{kind}: {count} {"stale" if dry_run else "repaired"}')
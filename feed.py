@@ -0,0 +1,199 @@
+"""Upkeep of the denormalized homepage feed and post counters.
+
+`feed` holds one row per post with its author's name and tag names, and
+users/tags carry a `post_count`. The write routes call these helpers with
+the ids they touched, after flushing and before committing. Feed rows are
+recomputed from the source tables, so refreshing one twice is harmless;
+counters are moved by the number of rows a write actually inserted or
+deleted, so they never re-count a busy user's or tag's posts. `verify`
+sweeps everything in batches and repairs any drift.
+"""
+import json
+from datetime import datetime
+
+from sqlalchemy import case, delete, func, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db, User, Post, PostTag, Tag, FeedItem
+
+feed = FeedItem.__table__
+
+
+def _upsert():
+    dialect = db.session.get_bind().dialect.name
+    statement = (postgresql if dialect == 'postgresql' else sqlite).insert(feed)
+    return statement.on_conflict_do_update(
+        index_elements=[feed.c.post_id],
+        set_={column.name: statement.excluded[column.name]
+              for column in feed.c if column.name != 'post_id'})
+
+
+def _expected_rows(post_ids):
+    """The feed rows `post_ids` should have, keyed by post id."""
+
+    rows = {}
+    for post_id, user_id, created_at, title, content, first_name, last_name in db.session.execute(
+            select(Post.id, Post.user_id, Post.created_at, Post.title, Post.content,
+                   User.first_name, User.last_name)
+            .join(User, User.id == Post.user_id)
+            .where(Post.id.in_(post_ids))):
+        rows[post_id] = {'post_id': post_id, 'user_id': user_id, 'created_at': created_at,
+                         'title': title, 'content': content,
+                         'author_name': f'{first_name} {last_name}', 'tags': []}
+    for post_id, tag_id, name in db.session.execute(
+            select(PostTag.post_id, Tag.id, Tag.name)
+            .join(Tag, Tag.id == PostTag.tag_id)
+            .where(PostTag.post_id.in_(post_ids))
+            .order_by(PostTag.post_id, Tag.id)):
+        rows[post_id]['tags'].append([tag_id, name])
+    for row in rows.values():
+        row['tags_json'] = json.dumps(row.pop('tags'))
+    return rows
+
+
+def refresh_posts(post_ids):
+    """Rewrite the feed rows of `post_ids` (new, edited or retagged posts)."""
+
+    post_ids = list(set(post_ids))
+    if not post_ids:
+        return
+    rows = _expected_rows(post_ids)
+    now = datetime.utcnow()
+    for row in rows.values():
+        row['updated_at'] = now
+    # Upserted rather than deleted and re-inserted, so two requests
+    # refreshing the same post can't both find the row gone and collide
+    # on its primary key.
+    if rows:
+        db.session.execute(_upsert(), list(rows.values()))
+    gone = set(post_ids) - rows.keys()
+    if gone:
+        remove_posts(gone)
+
+
+def rename_tag(tag_id, old_name, new_name):
+    """Swap a renamed tag's entry in tags_json on the feed rows of the posts
+    carrying it, in one UPDATE. Nothing is read, and the rest of each
+    row, including the other tags, is left as it is."""
+
+    db.session.execute(
+        update(FeedItem)
+        .where(FeedItem.post_id.in_(select(PostTag.post_id).where(PostTag.tag_id == tag_id)))
+        .values(tags_json=func.replace(FeedItem.tags_json,
+                                       json.dumps([tag_id, old_name]),
+                                       json.dumps([tag_id, new_name])),
+                updated_at=datetime.utcnow()),
+        execution_options={'synchronize_session': False})
+
+
+def remove_posts(post_ids):
+    """Drop the feed rows of deleted posts."""
+
+    if post_ids:
+        db.session.execute(delete(FeedItem).where(FeedItem.post_id.in_(list(post_ids))))
+
+
+def refresh_author(user):
+    """Rename `user` on all of their feed rows in one UPDATE."""
+
+    db.session.execute(update(FeedItem)
+                       .where(FeedItem.user_id == user.id)
+                       .values(author_name=user.full_name, updated_at=datetime.utcnow()))
+
+
+def _count_posts(model, deltas):
+    deltas = {key: n for key, n in deltas.items() if n}
+    if deltas:
+        db.session.execute(
+            update(model)
+            .where(model.id.in_(list(deltas)))
+            .values(post_count=model.post_count + case(deltas, value=model.id)),
+            execution_options={'synchronize_session': False})
+
+
+def count_user_posts(deltas):
+    """Add `deltas[user_id]` to each user's post_count (posts created or
+    deleted)."""
+
+    _count_posts(User, deltas)
+
+
+def count_tag_posts(deltas):
+    """Add `deltas[tag_id]` to each tag's post_count (links added or
+    removed)."""
+
+    _count_posts(Tag, deltas)
+
+
+def recount_users(user_ids):
+    """Set post_count on `user_ids` from the posts table (verify)."""
+
+    if user_ids:
+        db.session.execute(
+            update(User)
+            .where(User.id.in_(list(set(user_ids))))
+            .values(post_count=select(func.count(Post.id))
+                    .where(Post.user_id == User.id)
+                    .scalar_subquery()),
+            execution_options={'synchronize_session': False})
+
+
+def recount_tags(tag_ids):
+    """Set post_count on `tag_ids` from the posts_tags table (verify)."""
+
+    if tag_ids:
+        db.session.execute(
+            update(Tag)
+            .where(Tag.id.in_(list(set(tag_ids))))
+            .values(post_count=select(func.count(PostTag.post_id))
+                    .where(PostTag.tag_id == Tag.id)
+                    .scalar_subquery()),
+            execution_options={'synchronize_session': False})
+
+
+############VERIFY################
+
+FEED_COLUMNS = [column for column in FeedItem.__table__.c if column.name != 'updated_at']
+
+
+def verify(batch_size=10_000, repair=True):
+    """Compare the counters and feed against the source tables, fixing any
+    drift unless `repair` is False. Returns how many rows were off, by kind.
+
+    Works through posts in id order one batch at a time, committing after
+    each, so it can run against a live database.
+    """
+
+    drift = {'users': 0, 'tags': 0, 'feed': 0}
+
+    for model, counted, key in [(User, Post.id, Post.user_id), (Tag, PostTag.post_id, PostTag.tag_id)]:
+        actual = select(func.count(counted)).where(key == model.id).scalar_subquery()
+        stale = db.session.execute(select(model.id).where(model.post_count != actual)).scalars().all()
+        drift[model.__tablename__] = len(stale)
+        if repair:
+            for start in range(0, len(stale), batch_size):
+                (recount_users if model is User else recount_tags)(stale[start:start + batch_size])
+                db.session.commit()
+
+    after = 0
+    while True:
+        post_ids = db.session.execute(
+            select(Post.id).where(Post.id > after).order_by(Post.id).limit(batch_size)).scalars().all()
+        # Feed rows in the same id range, plus any past the last post.
+        query = select(*FEED_COLUMNS).where(FeedItem.post_id > after)
+        if post_ids:
+            query = query.where(FeedItem.post_id <= post_ids[-1])
+        actual = {row.post_id: row._asdict() for row in db.session.execute(query)}
+        if not post_ids and not actual:
+            break
+        expected = _expected_rows(post_ids) if post_ids else {}
+        stale = [post_id for post_id in expected if expected[post_id] != actual.get(post_id)]
+        orphans = [post_id for post_id in actual if post_id not in expected]
+        drift['feed'] += len(stale) + len(orphans)
+        if repair:
+            refresh_posts(stale)
+            remove_posts(orphans)
+            db.session.commit()
+        if not post_ids:
+            break
+        after = post_ids[-1]
+    return drift
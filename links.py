@@ -0,0 +1,105 @@
+"""Set-based writes to the posts_tags link table.
+
+The tag forms and /tags/links change many post/tag links at once. Rather
+than loading `Tag.posts` and letting the ORM diff the collection, they
+send only the links to add and remove; these run one INSERT ... ON
+CONFLICT DO NOTHING for new links and one DELETE for removed ones, and
+hand back the pairs that actually changed so the caller can bring
+everything derived from them up to date with `record_changes`.
+"""
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import literal, select, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, Post, PostTag, Tag
+import feed
+
+links = PostTag.__table__
+
+
+def _insert():
+    dialect = db.session.get_bind().dialect.name
+    return (postgresql if dialect == 'postgresql' else sqlite).insert(links)
+
+
+def add_links(pairs):
+    """Link each (post_id, tag_id) in `pairs`, skipping links that already
+    exist. Returns the pairs inserted."""
+
+    pairs = [{'post_id': post_id, 'tag_id': tag_id} for post_id, tag_id in set(pairs)]
+    if not pairs:
+        return []
+    return [tuple(row) for row in db.session.execute(
+        _insert().on_conflict_do_nothing().returning(links.c.post_id, links.c.tag_id),
+        pairs)]
+
+
+def remove_links(pairs):
+    """Unlink each (post_id, tag_id) in `pairs`. Returns the pairs deleted."""
+
+    pairs = set(pairs)
+    if not pairs:
+        return []
+    return [tuple(row) for row in db.session.execute(
+        links.delete()
+        .where(tuple_(links.c.post_id, links.c.tag_id).in_(pairs))
+        .returning(links.c.post_id, links.c.tag_id))]
+
+
+def tag_posts(tag_id, post_ids):
+    """Link `tag_id` to each of `post_ids`; ids of posts that don't exist
+    are ignored. Returns the (post_id, tag_id) pairs added."""
+
+    post_ids = {int(post_id) for post_id in post_ids}
+    if not post_ids:
+        return []
+    return [tuple(row) for row in db.session.execute(
+        _insert()
+        .from_select(['post_id', 'tag_id'],
+                     select(Post.id, literal(tag_id)).where(Post.id.in_(post_ids)))
+        .on_conflict_do_nothing()
+        .returning(links.c.post_id, links.c.tag_id))]
+
+
+def untag_posts(tag_id, post_ids):
+    """Unlink `tag_id` from each of `post_ids`. Returns the pairs deleted."""
+
+    return remove_links((int(post_id), tag_id) for post_id in post_ids)
+
+
+def missing_ids(pairs):
+    """The post and tag ids in `pairs` that don't exist, by kind."""
+
+    post_ids = {post_id for post_id, _ in pairs}
+    tag_ids = {tag_id for _, tag_id in pairs}
+    missing = {}
+    if post_ids:
+        missing['posts'] = sorted(post_ids - set(db.session.execute(
+            select(Post.id).where(Post.id.in_(post_ids))).scalars()))
+    if tag_ids:
+        missing['tags'] = sorted(tag_ids - set(db.session.execute(
+            select(Tag.id).where(Tag.id.in_(tag_ids))).scalars()))
+    return {kind: ids for kind, ids in missing.items() if ids}
+
+
+def record_changes(added, removed=()):
+    """Bump updated_at on the posts whose links were `added` or `removed`,
+    refresh their feed rows and move their tags' post counts (which also
+    bumps the tags' updated_at). Returns the cache dependencies to
+    invalidate once committed."""
+
+    pairs = list(added) + list(removed)
+    post_ids = {post_id for post_id, _ in pairs}
+    tag_ids = {tag_id for _, tag_id in pairs}
+    if post_ids:
+        db.session.execute(update(Post).where(Post.id.in_(post_ids))
+                           .values(updated_at=datetime.utcnow()),
+                           execution_options={'synchronize_session': False})
+    feed.refresh_posts(post_ids)
+    deltas = Counter(tag_id for _, tag_id in added)
+    deltas.subtract(tag_id for _, tag_id in removed)
+    feed.count_tag_posts(deltas)
+    return ([f'post:{post_id}' for post_id in sorted(post_ids)]
+            + [f'tag:{tag_id}' for tag_id in sorted(tag_ids)])
@@ -0,0 +1,187 @@
+"""Per-request performance instrumentation.
+
+For every request this records the number of SQL statements, time spent
+in the database, time spent rendering templates and total latency,
+labelled by endpoint. The numbers go out two ways: a `Server-Timing`
+header on each response (except streamed ones, which are measured when
+they finish sending), and running totals served in Prometheus text
+format at /metrics.
+
+Config:
+    MAX_QUERIES_PER_REQUEST  in testing mode, fail any request that runs
+                             more SQL statements than this
+    SLOW_QUERY_MS            log statements slower than this (off if None)
+    SLOW_QUERY_SAMPLE_RATE   fraction of slow statements to log
+"""
+import logging
+import random
+import threading
+import time
+from collections import Counter
+
+from flask import g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+
+slow_query_log = logging.getLogger('blogly.slow_query')
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Metrics:
+    """Process-wide running totals per endpoint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = Counter()
+            self.queries = Counter()
+            self.db_seconds = Counter()
+            self.render_seconds = Counter()
+            self.latency_buckets = {}
+            self.latency_sum = Counter()
+
+    def observe(self, endpoint, method, status, total, db_time, queries, render_time):
+        with self._lock:
+            self.requests[endpoint, method, status] += 1
+            self.queries[endpoint] += queries
+            self.db_seconds[endpoint] += db_time
+            self.render_seconds[endpoint] += render_time
+            self.latency_sum[endpoint] += total
+            buckets = self.latency_buckets.setdefault(endpoint, [0] * (len(BUCKETS) + 1))
+            for i, bound in enumerate(BUCKETS):
+                if total <= bound:
+                    buckets[i] += 1
+            buckets[-1] += 1
+
+    def render(self):
+        """The totals in Prometheus text exposition format."""
+
+        lines = []
+        with self._lock:
+            lines += ['# HELP blogly_requests_total Requests served.',
+                      '# TYPE blogly_requests_total counter']
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(f'blogly_requests_total{{endpoint="{endpoint}",method="{method}",'
+                             f'status="{status}"}} {count}')
+            for name, help, totals in [
+                ('blogly_db_queries_total', 'SQL statements run.', self.queries),
+                ('blogly_db_seconds_total', 'Time spent running SQL.', self.db_seconds),
+                ('blogly_render_seconds_total', 'Time spent rendering templates.', self.render_seconds),
+            ]:
+                lines += [f'# HELP {name} {help}', f'# TYPE {name} counter']
+                for endpoint, value in sorted(totals.items()):
+                    lines.append(f'{name}{{endpoint="{endpoint}"}} {value:g}')
+            lines += ['# HELP blogly_request_duration_seconds Request latency.',
+                      '# TYPE blogly_request_duration_seconds histogram']
+            for endpoint, buckets in sorted(self.latency_buckets.items()):
+                for bound, count in zip(BUCKETS, buckets):
+                    lines.append(f'blogly_request_duration_seconds_bucket'
+                                 f'{{endpoint="{endpoint}",le="{bound:g}"}} {count}')
+                lines.append(f'blogly_request_duration_seconds_bucket'
+                             f'{{endpoint="{endpoint}",le="+Inf"}} {buckets[-1]}')
+                lines.append(f'blogly_request_duration_seconds_sum{{endpoint="{endpoint}"}} '
+                             f'{self.latency_sum[endpoint]:g}')
+                lines.append(f'blogly_request_duration_seconds_count{{endpoint="{endpoint}"}} '
+                             f'{buckets[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+############SQL HOOKS################
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(config):
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        if has_request_context():
+            g.query_count = g.get('query_count', 0) + 1
+            g.db_time = g.get('db_time', 0.0) + elapsed
+
+        threshold = config.get('SLOW_QUERY_MS')
+        if (threshold is not None and elapsed * 1000 >= threshold
+                and random.random() < config.get('SLOW_QUERY_SAMPLE_RATE', 1.0)):
+            slow_query_log.warning('%.1f ms %s: %s', elapsed * 1000,
+                                   request.endpoint if has_request_context() else '-',
+                                   statement)
+    return after_cursor_execute
+
+
+############TEMPLATE HOOKS################
+
+def _before_render(sender, template, context, **extra):
+    g.setdefault('render_starts', []).append(time.perf_counter())
+
+
+def _after_render(sender, template, context, **extra):
+    starts = g.get('render_starts')
+    if not starts:
+        return
+    start = starts.pop()
+    # Templates rendered inside another (cached fragments) count once.
+    if not starts:
+        g.render_time = g.get('render_time', 0.0) + time.perf_counter() - start
+
+
+def init_app(app, db):
+    """Install the SQL, template and request hooks and the /metrics view."""
+
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', _after_cursor_execute(app.config))
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+        g.query_count = 0
+        g.db_time = 0.0
+        g.render_time = 0.0
+
+    def finish(stats, endpoint, method, status):
+        """Observe a finished request from its `g`; returns the timings."""
+
+        total = time.perf_counter() - stats.get('request_start', time.perf_counter())
+        queries = stats.get('query_count', 0)
+        db_time = stats.get('db_time', 0.0)
+        render_time = stats.get('render_time', 0.0)
+        metrics.observe(endpoint, method, status, total, db_time, queries, render_time)
+
+        limit = app.config.get('MAX_QUERIES_PER_REQUEST')
+        if app.testing and limit is not None:
+            assert queries <= limit, (
+                f"{endpoint} ran {queries} SQL statements (limit {limit})")
+        return total, db_time, queries, render_time
+
+    @app.after_request
+    def record_request(response):
+        endpoint = request.endpoint or 'unmatched'
+        if response.is_streamed:
+            # The body, and the queries behind it, are produced only as it
+            # is sent, so count them once it is closed. The headers are gone
+            # by then: streamed responses carry no Server-Timing.
+            stats, method, status = g._get_current_object(), request.method, response.status_code
+            response.call_on_close(lambda: finish(stats, endpoint, method, status))
+            return response
+
+        total, db_time, queries, render_time = finish(g, endpoint, request.method, response.status_code)
+        response.headers['Server-Timing'] = (
+            f'db;dur={db_time * 1000:.2f};desc="{queries} queries", '
+            f'render;dur={render_time * 1000:.2f}, '
+            f'total;dur={total * 1000:.2f}')
+        return response
+
+    @app.route('/metrics')
+    def metrics_view():
+        """Serve the running totals in Prometheus text format."""
+
+        return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
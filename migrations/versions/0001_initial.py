@@ -0,0 +1,61 @@
+"""initial schema, as db.create_all() used to build it
+
+Databases created before migrations existed already have these tables;
+mark them with `flask db stamp 0001_initial` and then `flask db upgrade`.
+
+Revision ID: 0001_initial
+Revises: 
+Create Date: 2026-10-18 18:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001_initial'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('users',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('first_name', sa.String(), nullable=False),
+        sa.Column('last_name', sa.String(), nullable=False),
+        sa.Column('image_url', sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('tags',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('name', sa.String(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('name')
+    )
+    op.create_table('posts',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('title', sa.String(), nullable=False),
+        sa.Column('content', sa.String(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    # SQLite can't autoincrement one column of a composite key.
+    op.create_table('posts_tags',
+        sa.Column('id', sa.Integer(), nullable=False,
+                  autoincrement=op.get_bind().dialect.name != 'sqlite'),
+        sa.Column('post_id', sa.Integer(), nullable=False),
+        sa.Column('tag_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['post_id'], ['posts.id'], ),
+        sa.ForeignKeyConstraint(['tag_id'], ['tags.id'], ),
+        sa.PrimaryKeyConstraint('id', 'post_id', 'tag_id')
+    )
+
+
+def downgrade():
+    op.drop_table('posts_tags')
+    op.drop_table('posts')
+    op.drop_table('tags')
+    op.drop_table('users')
@@ -0,0 +1,32 @@
+"""updated_at row versions on users, posts and tags
+
+Revision ID: 0002_updated_at
+Revises: 0001_initial
+Create Date: 2026-10-18 18:11:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002_updated_at'
+down_revision = '0001_initial'
+branch_labels = None
+depends_on = None
+
+TABLES = ['users', 'posts', 'tags']
+
+
+def upgrade():
+    for table in TABLES:
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(), nullable=True))
+        op.execute(f"UPDATE {table} SET updated_at = CURRENT_TIMESTAMP")
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column('updated_at', existing_type=sa.DateTime(), nullable=False)
+
+
+def downgrade():
+    for table in TABLES:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('updated_at')
@@ -0,0 +1,40 @@
+"""full-text search index over posts
+
+Postgres: a weighted tsvector column with a GIN index.
+SQLite: a posts_fts FTS5 table keyed by post id.
+
+Revision ID: 0003_search_index
+Revises: 0002_updated_at
+Create Date: 2026-10-18 18:12:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003_search_index'
+down_revision = '0002_updated_at'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("ALTER TABLE posts ADD COLUMN search_vector tsvector")
+        op.execute("UPDATE posts SET search_vector = "
+                   "setweight(to_tsvector('english', title), 'A') || "
+                   "setweight(to_tsvector('english', content), 'B')")
+        op.execute("CREATE INDEX posts_search_vector_idx ON posts USING GIN (search_vector)")
+    else:
+        op.execute("CREATE VIRTUAL TABLE posts_fts USING fts5(title, content)")
+        op.execute("INSERT INTO posts_fts (rowid, title, content) "
+                   "SELECT id, title, content FROM posts")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("DROP INDEX posts_search_vector_idx")
+        op.execute("ALTER TABLE posts DROP COLUMN search_vector")
+    else:
+        op.execute("DROP TABLE posts_fts")
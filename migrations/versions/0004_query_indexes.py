@@ -0,0 +1,65 @@
+"""indexes for the hot query shapes; (post_id, tag_id) key on posts_tags
+
+posts_tags used to be keyed on (id, post_id, tag_id), which let the same
+post/tag pair be stored twice. It is rebuilt keyed on (post_id, tag_id),
+keeping one row per pair, with a (tag_id, post_id) index for the tag side.
+
+The posts indexes are built CONCURRENTLY on Postgres so writes aren't
+blocked while a large table is indexed.
+
+Revision ID: 0004_query_indexes
+Revises: 0003_search_index
+Create Date: 2026-10-18 18:13:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004_query_indexes'
+down_revision = '0003_search_index'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("CREATE TABLE posts_tags_dedup AS SELECT DISTINCT post_id, tag_id FROM posts_tags")
+    op.drop_table('posts_tags')
+    op.create_table('posts_tags',
+        sa.Column('post_id', sa.Integer(), nullable=False),
+        sa.Column('tag_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['post_id'], ['posts.id'], ),
+        sa.ForeignKeyConstraint(['tag_id'], ['tags.id'], ),
+        sa.PrimaryKeyConstraint('post_id', 'tag_id')
+    )
+    op.execute("INSERT INTO posts_tags (post_id, tag_id) SELECT post_id, tag_id FROM posts_tags_dedup")
+    op.drop_table('posts_tags_dedup')
+    op.create_index('ix_posts_tags_tag_id_post_id', 'posts_tags', ['tag_id', 'post_id'])
+
+    with op.get_context().autocommit_block():
+        op.create_index('ix_posts_created_at', 'posts', [sa.text('created_at DESC')],
+                        postgresql_concurrently=True)
+        op.create_index('ix_posts_user_id_created_at', 'posts', ['user_id', 'created_at'],
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    op.drop_index('ix_posts_user_id_created_at', table_name='posts')
+    op.drop_index('ix_posts_created_at', table_name='posts')
+    op.drop_index('ix_posts_tags_tag_id_post_id', table_name='posts_tags')
+    op.execute("CREATE TABLE posts_tags_dedup AS SELECT post_id, tag_id FROM posts_tags")
+    op.drop_table('posts_tags')
+    op.create_table('posts_tags',
+        sa.Column('id', sa.Integer(), nullable=False,
+                  autoincrement=op.get_bind().dialect.name != 'sqlite'),
+        sa.Column('post_id', sa.Integer(), nullable=False),
+        sa.Column('tag_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['post_id'], ['posts.id'], ),
+        sa.ForeignKeyConstraint(['tag_id'], ['tags.id'], ),
+        sa.PrimaryKeyConstraint('id', 'post_id', 'tag_id')
+    )
+    op.execute("INSERT INTO posts_tags (id, post_id, tag_id) "
+               "SELECT ROW_NUMBER() OVER (ORDER BY post_id, tag_id), post_id, tag_id "
+               "FROM posts_tags_dedup")
+    op.drop_table('posts_tags_dedup')
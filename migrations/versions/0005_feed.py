@@ -0,0 +1,89 @@
+"""post_count on users and tags; denormalized homepage feed table
+
+Both are backfilled from the existing rows. Afterwards the app keeps them
+current, and `flask blogly verify-feed` checks for (and repairs) drift.
+
+Revision ID: 0005_feed
+Revises: 0004_query_indexes
+Create Date: 2026-10-18 18:15:00.000000
+
+"""
+import json
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005_feed'
+down_revision = '0004_query_indexes'
+branch_labels = None
+depends_on = None
+
+BATCH = 10_000
+
+COUNTS = {
+    'users': "SELECT COUNT(*) FROM posts WHERE posts.user_id = users.id",
+    'tags': "SELECT COUNT(*) FROM posts_tags WHERE posts_tags.tag_id = tags.id",
+}
+
+
+def _backfill_feed(feed):
+    conn = op.get_bind()
+    now = datetime.utcnow()
+    after = 0
+    while True:
+        posts = conn.execute(sa.text(
+            "SELECT posts.id, posts.user_id, posts.created_at, posts.title, posts.content, "
+            "users.first_name, users.last_name FROM posts JOIN users ON users.id = posts.user_id "
+            "WHERE posts.id > :after ORDER BY posts.id LIMIT :limit")
+            .columns(created_at=sa.DateTime()),
+            {'after': after, 'limit': BATCH}).all()
+        if not posts:
+            break
+        after = posts[-1].id
+        tags = {}
+        for post_id, tag_id, name in conn.execute(sa.text(
+                "SELECT posts_tags.post_id, tags.id, tags.name FROM posts_tags "
+                "JOIN tags ON tags.id = posts_tags.tag_id "
+                "WHERE posts_tags.post_id BETWEEN :first AND :last "
+                "ORDER BY posts_tags.post_id, tags.id"),
+                {'first': posts[0].id, 'last': after}):
+            tags.setdefault(post_id, []).append([tag_id, name])
+        conn.execute(feed.insert(), [
+            {'post_id': post.id, 'user_id': post.user_id, 'created_at': post.created_at,
+             'updated_at': now, 'title': post.title, 'content': post.content,
+             'author_name': f'{post.first_name} {post.last_name}',
+             'tags_json': json.dumps(tags.get(post.id, []))}
+            for post in posts])
+
+
+def upgrade():
+    for table, count in COUNTS.items():
+        op.add_column(table, sa.Column('post_count', sa.Integer(), server_default='0', nullable=False))
+        op.execute(f"UPDATE {table} SET post_count = ({count})")
+
+    feed = op.create_table('feed',
+        sa.Column('post_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.Column('title', sa.String(), nullable=False),
+        sa.Column('content', sa.String(), nullable=False),
+        sa.Column('author_name', sa.String(), nullable=False),
+        sa.Column('tags_json', sa.Text(), nullable=False),
+        sa.PrimaryKeyConstraint('post_id')
+    )
+    op.create_index('ix_feed_created_at', 'feed', [sa.text('created_at DESC')])
+    op.create_index('ix_feed_user_id', 'feed', ['user_id'])
+    _backfill_feed(feed)
+
+
+def downgrade():
+    op.drop_index('ix_feed_user_id', table_name='feed')
+    op.drop_index('ix_feed_created_at', table_name='feed')
+    op.drop_table('feed')
+    for table in COUNTS:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('post_count')
@@ -0,0 +1,25 @@
+"""avatar_digest on users, naming the locally stored avatar thumbnails
+
+Revision ID: 0006_avatar_digest
+Revises: 0005_feed
+Create Date: 2026-10-18 18:17:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006_avatar_digest'
+down_revision = '0005_feed'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('avatar_digest', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('avatar_digest')
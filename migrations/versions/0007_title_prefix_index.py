@@ -0,0 +1,34 @@
+"""unstemmed title index for the post picker's prefix type-ahead
+
+The search_vector is built with the 'english' config, so its terms are
+stems ("posting" is stored as "post") and a partial word such as
+"postin" matches nothing. Prefix lookups use to_tsvector('simple', title)
+instead, through its own GIN expression index. Postgres only: the SQLite
+FTS5 table doesn't stem.
+
+Revision ID: 0007_title_prefix_index
+Revises: 0006_avatar_digest
+Create Date: 2026-10-18 18:18:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0007_title_prefix_index'
+down_revision = '0006_avatar_digest'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.execute("CREATE INDEX CONCURRENTLY posts_title_prefix_idx "
+                       "ON posts USING GIN (to_tsvector('simple', title))")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("DROP INDEX posts_title_prefix_idx")
@@ -1,9 +1,23 @@
 """Models for Blogly."""
+import json
+from collections import namedtuple
+
 from flask_sqlalchemy import SQLAlchemy
+from flask_migrate import Migrate
 from datetime import datetime
 
+from routing import RoutingSession
+
+
+def _include_in_migrations(obj, name, type_, reflected, compare_to):
+    """Keep autogenerate away from the search index, which the migrations
+    manage by hand (see search.py)."""
 
-db = SQLAlchemy()
+    return not (name.startswith('posts_fts') or name == 'search_vector')
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+migrate = Migrate(include_object=_include_in_migrations)
 
 
 class User(db.Model):
@@ -12,6 +26,9 @@ class User(db.Model):
     first_name = db.Column(db.String, nullable=False)
     last_name = db.Column(db.String, nullable=False)
     image_url = db.Column(db.String, default='static/images/default_profile.png')
+    avatar_digest = db.Column(db.String(64))
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     posts = db.relationship("Post", backref="user", cascade="all, delete-orphan")
 
     def __repr__(self):
@@ -27,8 +44,13 @@ class Post(db.Model):
     title = db.Column(db.String, nullable=False)
     content = db.Column(db.String, nullable=False)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_posts_created_at', created_at.desc()),
+        db.Index('ix_posts_user_id_created_at', user_id, created_at),
+    )
 
     @property
     def friendly_date(self):
@@ -39,7 +61,9 @@ class Post(db.Model):
 class PostTag(db.Model):
     """manages many2many rs between posts and tags."""
     __tablename__ = 'posts_tags'
-    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    __table_args__ = (
+        db.Index('ix_posts_tags_tag_id_post_id', 'tag_id', 'post_id'),
+    )
     post_id = db.Column(db.Integer, 
                         db.ForeignKey('posts.id'),
                         primary_key=True, )
@@ -51,6 +75,8 @@ class Tag(db.Model):
     __tablename__ = 'tags'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String, unique= True, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     posts = db.relationship(
         'Post',
@@ -58,9 +84,48 @@ class Tag(db.Model):
         backref='tags',
     )
 
+FeedTag = namedtuple('FeedTag', ['id', 'name'])
+
+class FeedItem(db.Model):
+    """Denormalized copy of a post with its author's name and its tags, so
+    the homepage reads one table with no joins. Kept current by feed.py."""
+    __tablename__ = 'feed'
+    post_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+    title = db.Column(db.String, nullable=False)
+    content = db.Column(db.String, nullable=False)
+    author_name = db.Column(db.String, nullable=False)
+    tags_json = db.Column(db.Text, nullable=False, default='[]')
+
+    __table_args__ = (
+        db.Index('ix_feed_created_at', created_at.desc()),
+        db.Index('ix_feed_user_id', user_id),
+    )
+
+    friendly_date = Post.friendly_date
+
+    @property
+    def id(self):
+        return self.post_id
+
+    @property
+    def tags(self):
+        return [FeedTag(*tag) for tag in json.loads(self.tags_json)]
+
+def touch(*rows):
+    """Bump updated_at on rows whose rendered pages changed without any of
+    their own columns changing (e.g. a tag link was added or removed)."""
+
+    now = datetime.utcnow()
+    for row in rows:
+        row.updated_at = now
+
 def connect_db(app):
     db.app = app
     db.init_app(app)
+    migrate.init_app(app, db)
 
 
 
@@ -0,0 +1,238 @@
+"""Query layer for Blogly views.
+
+Each view loads its objects through one of these helpers so the
+relationships its template touches are fetched up front instead of one
+lazy load per row.
+"""
+import hashlib
+from datetime import datetime
+
+from flask import abort
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload, selectinload
+from models import db, User, Post, PostTag, Tag, FeedItem
+import search
+
+
+def recent_feed(limit=5):
+    """Most-recent posts from the denormalized feed, which already carries
+    each post's author name and tags (homepage)."""
+
+    return (FeedItem.query
+            .order_by(FeedItem.created_at.desc())
+            .limit(limit)
+            .all())
+
+
+def users_page(after=None, before=None, per_page=50):
+    """One page of users ordered by id, no relationships (user list)."""
+
+    return keyset_page(User.query, User.id, after, before, per_page)
+
+
+def get_user_or_404(user_id):
+    """A single user, no relationships (edit/delete forms)."""
+
+    return User.query.get_or_404(user_id)
+
+
+def get_user_with_posts_or_404(user_id):
+    """A user along with their posts (user detail)."""
+
+    return User.query.options(selectinload(User.posts)).get_or_404(user_id)
+
+
+def get_user_for_delete_or_404(user_id):
+    """A user with their posts and those posts' tags, so the cascade
+    delete doesn't lazy load each post's tag links."""
+
+    return (User.query
+            .options(selectinload(User.posts).selectinload(Post.tags))
+            .get_or_404(user_id))
+
+
+def get_post_or_404(post_id):
+    """A single post, no relationships (edit/delete forms)."""
+
+    return Post.query.get_or_404(post_id)
+
+
+def get_post_with_details_or_404(post_id):
+    """A post along with its author and tags (post detail)."""
+
+    return (Post.query
+            .options(joinedload(Post.user), selectinload(Post.tags))
+            .get_or_404(post_id))
+
+
+def post_titles_page(q=None, after=None, before=None, per_page=50):
+    """One page of (id, title) rows, narrowed to titles with words starting
+    with those of `q` (tag post pickers). Only the two columns are fetched,
+    no ORM objects; matching goes through the search index so a rare or
+    missing term costs an index lookup, not a table scan."""
+
+    if q:
+        matches = search.title_prefix_query(q)
+        if matches is None:
+            return Page([], next_after=None, prev_before=None)
+        return keyset_page(*matches, after, before, per_page)
+    return keyset_page(db.session.query(Post.id, Post.title), Post.id, after, before, per_page)
+
+
+def tagged_post_titles_page(tag_id, after=None, before=None, per_page=50):
+    """One page of (id, title) rows for the posts carrying a tag, walked
+    through the posts_tags index (tag edit form)."""
+
+    post_id = PostTag.post_id.label('id')
+    query = (db.session.query(post_id, Post.title)
+             .select_from(PostTag)
+             .join(Post, Post.id == PostTag.post_id)
+             .filter(PostTag.tag_id == tag_id))
+    return keyset_page(query, post_id, after, before, per_page)
+
+
+def tags_page(after=None, before=None, per_page=50):
+    """One page of tags ordered by id, no relationships (tag list)."""
+
+    return keyset_page(Tag.query, Tag.id, after, before, per_page)
+
+
+def get_tag_or_404(tag_id):
+    """A tag on its own (tag edit)."""
+
+    return Tag.query.get_or_404(tag_id)
+
+
+def get_tag_with_posts_or_404(tag_id):
+    """A tag along with its posts (tag detail)."""
+
+    return Tag.query.options(selectinload(Tag.posts)).get_or_404(tag_id)
+
+
+############KEYSET PAGINATION################
+
+class Page:
+    """One slice of a keyset-paginated query.
+
+    `next_after` and `prev_before` are the cursors for the neighbouring
+    pages, or None when there is nothing in that direction.
+    """
+
+    def __init__(self, items, next_after=None, prev_before=None):
+        self.items = items
+        self.next_after = next_after
+        self.prev_before = prev_before
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def keyset_page(query, column, after=None, before=None, per_page=50):
+    """Fetch the `per_page` rows of `query` just after or just before a
+    cursor value of `column` (a unique, indexed column such as an id).
+
+    Unlike OFFSET paging this seeks straight to the cursor through the
+    index, so every page costs the same no matter how deep it is.
+    """
+
+    def key(row):
+        return getattr(row, column.key)
+
+    if before is not None:
+        rows = (query.filter(column < before)
+                .order_by(column.desc())
+                .limit(per_page + 1)
+                .all())
+        has_prev = len(rows) > per_page
+        rows = rows[:per_page][::-1]
+        return Page(rows,
+                    next_after=key(rows[-1]) if rows else None,
+                    prev_before=key(rows[0]) if has_prev else None)
+
+    if after is not None:
+        query = query.filter(column > after)
+    rows = query.order_by(column).limit(per_page + 1).all()
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+    return Page(rows,
+                next_after=key(rows[-1]) if has_next else None,
+                prev_before=key(rows[0]) if after is not None and rows else None)
+
+
+############CONDITIONAL GET################
+
+def _validators(rows):
+    """An (ETag, Last-Modified) pair for a page built from `rows`.
+
+    The ETag hashes every id, count and timestamp so it changes when a row
+    is added, removed or updated; Last-Modified is the newest timestamp.
+    """
+
+    if not rows:
+        abort(404)
+    rows = [tuple(row) for row in rows]
+    etag = hashlib.sha1(repr(rows).encode()).hexdigest()
+    stamps = [value for row in rows for value in row if isinstance(value, datetime)]
+    return etag, max(stamps, default=None)
+
+
+def home_version(limit=5):
+    """Validators for the homepage: the newest feed rows, which are
+    rewritten whenever their post, author or tags change.
+
+    ETag only: deleting the newest post drops its row, so the newest
+    timestamp left can be older than one a client already has, and a
+    Last-Modified check would wrongly answer 304.
+    """
+
+    rows = (db.session.query(FeedItem.post_id, FeedItem.updated_at)
+            .order_by(FeedItem.created_at.desc())
+            .limit(limit)
+            .all())
+    if not rows:
+        return 'empty', None
+    etag, _ = _validators(rows)
+    return etag, None
+
+
+def post_version(post_id):
+    """Validators for a post page: the post, its author and its tags."""
+
+    return _validators(
+        db.session.query(Post.id, Post.updated_at,
+                         User.updated_at, func.max(Tag.updated_at))
+        .join(User, User.id == Post.user_id)
+        .outerjoin(PostTag, PostTag.post_id == Post.id)
+        .outerjoin(Tag, Tag.id == PostTag.tag_id)
+        .filter(Post.id == post_id)
+        .group_by(Post.id, Post.updated_at, User.updated_at)
+        .all())
+
+
+def user_version(user_id):
+    """Validators for a user page: the user and their posts."""
+
+    return _validators(
+        db.session.query(User.id, User.updated_at,
+                         func.count(Post.id), func.max(Post.updated_at))
+        .outerjoin(Post, Post.user_id == User.id)
+        .filter(User.id == user_id)
+        .group_by(User.id, User.updated_at)
+        .all())
+
+
+def tag_version(tag_id):
+    """Validators for a tag page: the tag and its posts."""
+
+    return _validators(
+        db.session.query(Tag.id, Tag.updated_at,
+                         func.count(Post.id), func.max(Post.updated_at))
+        .outerjoin(PostTag, PostTag.tag_id == Tag.id)
+        .outerjoin(Post, Post.id == PostTag.post_id)
+        .filter(Tag.id == tag_id)
+        .group_by(Tag.id, Tag.updated_at)
+        .all())
+
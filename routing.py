@@ -0,0 +1,102 @@
+"""Database engine settings and read/write routing.
+
+When a read replica is configured, statements run while serving a GET or
+HEAD request go to it; everything else, and any statement that writes,
+goes to the primary. After a request commits, that client is pinned to
+the primary for READ_YOUR_WRITES_SECONDS so it sees its own writes even
+while the replica lags behind.
+
+Config:
+    DB_POOL_SIZE, DB_MAX_OVERFLOW    QueuePool sizing, per engine
+    DB_POOL_TIMEOUT                  seconds to wait for a free connection
+    DB_POOL_RECYCLE                  seconds before a connection is replaced
+    DB_POOL_PRE_PING                 test connections as they are checked out
+    DB_STATEMENT_TIMEOUT_MS          Postgres statement_timeout (off if None)
+    REPLICA_DATABASE_URL             read replica (off if None)
+    READ_YOUR_WRITES_SECONDS         how long a writer stays on the primary
+"""
+import time
+
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.sql.dml import UpdateBase
+
+REPLICA = 'replica'
+
+
+def engine_options(url, config):
+    """create_engine() keyword arguments for `url` from the DB_* settings."""
+
+    url = make_url(url)
+    options = {'pool_pre_ping': config['DB_POOL_PRE_PING']}
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        # Flask-SQLAlchemy gives in-memory SQLite a single shared connection.
+        return options
+    options.update(pool_size=config['DB_POOL_SIZE'],
+                   max_overflow=config['DB_MAX_OVERFLOW'],
+                   pool_timeout=config['DB_POOL_TIMEOUT'],
+                   pool_recycle=config['DB_POOL_RECYCLE'])
+    timeout = config.get('DB_STATEMENT_TIMEOUT_MS')
+    if timeout is not None and url.get_backend_name() == 'postgresql':
+        options['connect_args'] = {'options': f'-c statement_timeout={int(timeout)}'}
+    return options
+
+
+class RoutingSession(Session):
+    """Sends reads to the replica while the current request allows it."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and not isinstance(clause, UpdateBase)
+                and has_request_context() and g.get('read_replica')):
+            return self._db.engines[REPLICA]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _note_commit(db_session):
+    if has_request_context():
+        g.committed = True
+
+
+def configure(app):
+    """Fill in the engine options and the replica bind from the DB_*
+    settings. Call before connect_db()."""
+
+    config = app.config
+    config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(config['SQLALCHEMY_DATABASE_URI'], config)
+    replica = config.get('REPLICA_DATABASE_URL')
+    if replica:
+        config.setdefault('SQLALCHEMY_BINDS', {})[REPLICA] = {
+            'url': replica, **engine_options(replica, config)}
+
+
+def init_app(app, db):
+    """Install the request hooks that pick an engine and pin writers."""
+
+    @app.before_request
+    def choose_engine():
+        g.read_replica = (REPLICA in db.engines
+                          and request.method in ('GET', 'HEAD')
+                          and session.get('primary_until', 0) <= time.time())
+
+    @app.after_request
+    def pin_to_primary(response):
+        if g.get('committed'):
+            session['primary_until'] = time.time() + app.config['READ_YOUR_WRITES_SECONDS']
+        return response
+
+
+def pool_stats(db):
+    """Connection pool occupancy for every engine, by bind name."""
+
+    stats = {}
+    for name, engine in db.engines.items():
+        pool = engine.pool
+        entry = {'pool': type(pool).__name__, 'status': pool.status()}
+        for counter in ('size', 'checkedin', 'checkedout', 'overflow'):
+            if hasattr(pool, counter):
+                entry[counter] = getattr(pool, counter)()
+        stats[name or 'primary'] = entry
+    return stats
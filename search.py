@@ -0,0 +1,149 @@
+"""Full-text search over post titles and content.
+
+On Postgres posts get a `search_vector` tsvector column with a GIN index,
+plus a GIN index on the unstemmed `to_tsvector('simple', title)` for
+title prefix lookups; on SQLite (the tests) a separate FTS5 table
+`posts_fts` keyed by post id.
+Both are created alongside the posts table by `db.create_all()` and kept
+current by the post routes through `index_post` / `unindex_posts`.
+"""
+import re
+
+from sqlalchemy import DDL, Integer, String, bindparam, column, event, table, text
+from models import db, Post
+
+
+event.listen(Post.__table__, 'after_create', DDL(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(title, content)"
+).execute_if(dialect='sqlite'))
+event.listen(Post.__table__, 'after_drop', DDL(
+    "DROP TABLE IF EXISTS posts_fts"
+).execute_if(dialect='sqlite'))
+event.listen(Post.__table__, 'after_create', DDL(
+    "ALTER TABLE posts ADD COLUMN IF NOT EXISTS search_vector tsvector"
+).execute_if(dialect='postgresql'))
+event.listen(Post.__table__, 'after_create', DDL(
+    "CREATE INDEX IF NOT EXISTS posts_search_vector_idx ON posts USING GIN (search_vector)"
+).execute_if(dialect='postgresql'))
+
+event.listen(Post.__table__, 'after_create', DDL(
+    "CREATE INDEX IF NOT EXISTS posts_title_prefix_idx ON posts "
+    "USING GIN (to_tsvector('simple', title))"
+).execute_if(dialect='postgresql'))
+
+PG_VECTOR = ("setweight(to_tsvector('english', title), 'A') || "
+             "setweight(to_tsvector('english', content), 'B')")
+
+
+def _dialect():
+    return db.session.get_bind().dialect.name
+
+
+def index_post(post):
+    """Add or refresh `post` in the search index (call before commit)."""
+
+    db.session.flush()
+    if _dialect() == 'postgresql':
+        db.session.execute(text(f"UPDATE posts SET search_vector = {PG_VECTOR} WHERE id = :id"),
+                           {'id': post.id})
+    else:
+        db.session.execute(text("DELETE FROM posts_fts WHERE rowid = :id"), {'id': post.id})
+        db.session.execute(text("INSERT INTO posts_fts (rowid, title, content) "
+                                "VALUES (:id, :title, :content)"),
+                           {'id': post.id, 'title': post.title, 'content': post.content})
+
+
+def index_posts(post_ids):
+    """Add many newly inserted posts to the index in one statement (bulk
+    import; call before commit)."""
+
+    if not post_ids:
+        return
+    if _dialect() == 'postgresql':
+        sql = text(f"UPDATE posts SET search_vector = {PG_VECTOR} WHERE id IN :ids")
+    else:
+        sql = text("INSERT INTO posts_fts (rowid, title, content) "
+                   "SELECT id, title, content FROM posts WHERE id IN :ids")
+    db.session.execute(sql.bindparams(bindparam('ids', expanding=True)), {'ids': list(post_ids)})
+
+
+def unindex_posts(post_ids):
+    """Remove deleted posts from the search index (call before commit).
+
+    On Postgres the vector lives on the post row and goes with it.
+    """
+
+    if post_ids and _dialect() == 'sqlite':
+        db.session.execute(text("DELETE FROM posts_fts WHERE rowid = :id"),
+                           [{'id': post_id} for post_id in post_ids])
+
+
+def rebuild_index():
+    """Rebuild the whole index from the posts table (call before commit)."""
+
+    if _dialect() == 'postgresql':
+        db.session.execute(text(f"UPDATE posts SET search_vector = {PG_VECTOR}"))
+    else:
+        db.session.execute(text("DELETE FROM posts_fts"))
+        db.session.execute(text("INSERT INTO posts_fts (rowid, title, content) "
+                                "SELECT id, title, content FROM posts"))
+
+
+def _fts5_query(q):
+    """Quote each word so user input can't use FTS5 query syntax."""
+
+    return ' '.join('"{}"'.format(word.replace('"', '""')) for word in q.split())
+
+
+def title_prefix_query(q):
+    """A query of (id, title) rows for posts whose title has a word starting
+    with each word of `q` (the tag forms' type-ahead), and the id column to
+    keyset-page it on; None if `q` has no words.
+
+    Answered from an index, not a LIKE scan: the FTS5 table walks its
+    doclists in id order, and Postgres matches `term:*` prefixes through
+    the GIN index on the 'simple' (unstemmed) title vector; the stemmed
+    search_vector would lose partial words such as "postin" whose stem
+    differs from the full word's. Only word characters of `q` are used,
+    so nothing the user types is read as query syntax.
+    """
+
+    words = re.findall(r'\w+', q)
+    if not words:
+        return None
+    if _dialect() == 'postgresql':
+        query = (db.session.query(Post.id, Post.title)
+                 .filter(text("to_tsvector('simple', title) @@ to_tsquery('simple', :match)"))
+                 .params(match=' & '.join(f'{word}:*' for word in words)))
+        return query, Post.id
+    fts = table('posts_fts', column('rowid', Integer), column('title', String))
+    id_column = fts.c.rowid.label('id')
+    query = (db.session.query(id_column, fts.c.title)
+             .filter(text('posts_fts MATCH :match'))
+             .params(match='title : ({})'.format(
+                 ' AND '.join(f'"{word}"*' for word in words))))
+    return query, id_column
+
+
+def search_posts(q, page=1, per_page=20):
+    """Rows of (id, title) for posts matching `q`, best match first.
+
+    Returns one page of results plus whether another page follows.
+    """
+
+    if not q or not q.split():
+        return [], False
+    params = {'limit': per_page + 1, 'offset': (page - 1) * per_page}
+    if _dialect() == 'postgresql':
+        sql = text("SELECT id, title FROM posts, websearch_to_tsquery('english', :q) query "
+                   "WHERE search_vector @@ query "
+                   "ORDER BY ts_rank(search_vector, query) DESC, id "
+                   "LIMIT :limit OFFSET :offset")
+        params['q'] = q
+    else:
+        sql = text("SELECT rowid AS id, title FROM posts_fts WHERE posts_fts MATCH :q "
+                   "ORDER BY bm25(posts_fts, 2.0, 1.0), rowid "
+                   "LIMIT :limit OFFSET :offset")
+        params['q'] = _fts5_query(q)
+    rows = db.session.execute(sql, params).all()
+    return rows[:per_page], len(rows) > per_page
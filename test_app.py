@@ -1,6 +1,73 @@
+import io
+import json
+import os
+import threading
+import tempfile
 import unittest
+from contextlib import contextmanager
+from unittest.mock import patch
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
+
 from app import app, db
-from models import User, Post, Tag
+from models import User, Post, Tag, FeedItem
+from cache import cache, LRUCache, RedisCache
+from metrics import metrics
+import feed
+import routing
+import search
+from avatars import avatars, fetch, BlockedAddress, LocalStore
+import bench
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from flask_migrate import upgrade, downgrade
+from sqlalchemy import create_engine, event, text
+
+class FakeRedis:
+    """The slice of the redis-py client RedisCache uses, kept in a dict.
+    Like Redis, values and set members come back as bytes."""
+
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+
+    def _bytes(self, value):
+        return value if isinstance(value, bytes) else str(value).encode()
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = self._bytes(value)
+        self.ttls[key] = ex
+
+    def sadd(self, key, *members):
+        self.data.setdefault(key, set()).update(map(self._bytes, members))
+
+    def smembers(self, key):
+        return set(self.data.get(key, ()))
+
+    def expire(self, key, seconds):
+        self.ttls[key] = seconds
+
+    def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def scan_iter(self, pattern):
+        return [key for key in list(self.data) if key.startswith(pattern.rstrip('*'))]
+
+    def pipeline(self):
+        client, calls = self, []
+
+        class Pipeline:
+            def __getattr__(self, name):
+                return lambda *args, **kwargs: calls.append((name, args, kwargs))
+
+            def execute(self):
+                return [getattr(client, name)(*args, **kwargs) for name, args, kwargs in calls]
+        return Pipeline()
+
 
 class BloglyTestCase(unittest.TestCase):
     def setUp(self):
@@ -8,12 +75,23 @@ class BloglyTestCase(unittest.TestCase):
         app.config['TESTING'] = True
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
         self.client = app.test_client()
+        cache.clear()
+        metrics.reset()
 
         with app.app_context():
             db.create_all()
 
     def tearDown(self):
         """Clean up any leftover transactions."""
+        app.config['MAX_QUERIES_PER_REQUEST'] = 10
+        app.config['PER_PAGE'] = 50
+        app.config['SLOW_QUERY_MS'] = None
+        app.config['SLOW_QUERY_SAMPLE_RATE'] = 1.0
+        app.config['READ_YOUR_WRITES_SECONDS'] = 5
+        app.config['API_BATCH_SIZE'] = 1000
+        app.config['API_INCLUDE_LIMIT'] = 100
+        app.config['AVATAR_FETCH_ALLOWED_NETWORKS'] = ()
+        app.config['AVATAR_MAX_PIXELS'] = 25_000_000
         with app.app_context():
             db.session.remove()
             db.drop_all()
@@ -88,6 +166,826 @@ class BloglyTestCase(unittest.TestCase):
                 response = self.client.get(f'/tags/{new_tag.id}')
                 self.assertIn('Detail Tag', response.get_data(as_text=True))
             
+    def seed_posts(self, count=5):
+        """Add `count` users, each with a post carrying two tags."""
+        with app.app_context():
+            tags = [Tag(name='One'), Tag(name='Two')]
+            for i in range(count):
+                user = User(first_name='User', last_name=str(i))
+                Post(title=f'Post {i}', content='Content', user=user, tags=tags)
+                db.session.add(user)
+            search.rebuild_index()
+            db.session.commit()
+            feed.verify()
+            return User.query.first().id, Post.query.first().id, tags[0].id
+
+    def test_views_do_not_lazy_load(self):
+        """Relationship-heavy pages run a fixed number of queries."""
+        user_id, post_id, tag_id = self.seed_posts()
+        app.config['MAX_QUERIES_PER_REQUEST'] = 3
+        for url in ['/', f'/posts/{post_id}', f'/users/{user_id}',
+                    f'/tags/{tag_id}', f'/tags/{tag_id}/edit']:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+
+        response = self.client.get('/')
+        self.assertEqual(response.get_data(as_text=True).count('badge-primary'), 10)
+
+    def test_query_limit_is_enforced(self):
+        """A view that runs too many queries fails in testing mode."""
+        self.seed_posts()
+        app.config['MAX_QUERIES_PER_REQUEST'] = 1
+        with self.assertRaises(AssertionError):
+            self.client.get('/')
+
+    def test_user_list_pages(self):
+        """The user list is split into keyset pages with next/prev links."""
+        app.config['PER_PAGE'] = 2
+        with app.app_context():
+            for i in range(5):
+                db.session.add(User(first_name='Paged', last_name=f'User{i}'))
+            db.session.commit()
+
+        html = self.client.get('/users').get_data(as_text=True)
+        self.assertIn('User1', html)
+        self.assertNotIn('User2', html)
+        self.assertIn('/users?after=2', html)
+        self.assertNotIn('Previous', html)
+
+        html = self.client.get('/users?after=2').get_data(as_text=True)
+        self.assertIn('User2', html)
+        self.assertIn('User3', html)
+        self.assertIn('/users?before=3', html)
+        self.assertIn('/users?after=4', html)
+
+        html = self.client.get('/users?before=3').get_data(as_text=True)
+        self.assertIn('User0', html)
+        self.assertIn('User1', html)
+        self.assertNotIn('Previous', html)
+
+    def test_posts_lookup(self):
+        """The post picker lookup returns matching titles a page at a time."""
+        app.config['PER_PAGE'] = 2
+        self.seed_posts()
+        data = self.client.get('/posts/lookup?q=post').get_json()
+        self.assertEqual([p['title'] for p in data['posts']], ['Post 0', 'Post 1'])
+        data = self.client.get(f"/posts/lookup?q=post&after={data['next_after']}").get_json()
+        self.assertEqual([p['title'] for p in data['posts']], ['Post 2', 'Post 3'])
+        data = self.client.get('/posts/lookup?q=4').get_json()
+        self.assertEqual([p['title'] for p in data['posts']], ['Post 4'])
+        self.assertIsNone(data['next_after'])
+        data = self.client.get('/posts/lookup?q=PO').get_json()
+        self.assertEqual([p['title'] for p in data['posts']], ['Post 0', 'Post 1'])
+        # LIKE wildcards and FTS syntax are plain text, not patterns.
+        for q in ['_', '%', 'ost', '"post" OR content']:
+            self.assertEqual(self.client.get('/posts/lookup', query_string={'q': q}).get_json()['posts'], [], q)
+
+    def test_title_prefixes_use_unstemmed_vector_on_postgres(self):
+        """Postgres prefix lookups match the 'simple' title vector, so partial
+        words aren't compared against english stems."""
+        from sqlalchemy.dialects import postgresql
+        with app.app_context(), patch.object(search, '_dialect', return_value='postgresql'):
+            query, _ = search.title_prefix_query('postin Tag')
+            sql = str(query.statement.compile(dialect=postgresql.dialect()))
+            self.assertIn("to_tsvector('simple', title) @@ to_tsquery('simple', %(match)s)", sql)
+            self.assertEqual(query.statement.compile().params['match'], 'postin:* & Tag:*')
+
+    def test_tag_edit_form_checks_tagged_posts(self):
+        """Posts already carrying the tag are listed a page at a time, checked."""
+        app.config['PER_PAGE'] = 2
+        user_id, post_id, tag_id = self.seed_posts(3)
+        html = self.client.get(f'/tags/{tag_id}/edit').get_data(as_text=True)
+        self.assertEqual(html.count('checked>'), 2)
+        self.assertIn(f'/tags/{tag_id}/edit?after={post_id + 1}', html)
+        html = self.client.get(f'/tags/{tag_id}/edit?after={post_id + 1}').get_data(as_text=True)
+        self.assertEqual(html.count('checked>'), 1)
+        self.assertIn('Post 2', html)
+
+    def test_tag_edit_only_touches_shown_posts(self):
+        """Saving one page of the edit form leaves tagged posts on other pages alone."""
+        user_id, post_id, tag_id = self.seed_posts(3)
+        self.client.post(f'/tags/{tag_id}/edit', data={'name': 'One', 'shown': [post_id], 'keep': []})
+        with app.app_context():
+            tag = db.session.get(Tag, tag_id)
+            self.assertEqual(sorted(post.id for post in tag.posts), [post_id + 1, post_id + 2])
+            self.assertEqual(tag.post_count, 2)
+        self.client.post(f'/tags/{tag_id}/edit', data={'name': 'One', 'add': [post_id]})
+        with app.app_context():
+            self.assertEqual(db.session.get(Tag, tag_id).post_count, 3)
+
+    def test_homepage_is_not_stale_after_deleting_newest_post(self):
+        """The homepage sends no Last-Modified, which a delete could move backwards."""
+        self.seed_posts(6)
+        with app.app_context():
+            newest = Post.query.order_by(Post.id.desc()).first().id
+        response = self.client.get('/')
+        self.assertNotIn('Last-Modified', response.headers)
+        self.client.post(f'/posts/{newest}/delete')
+        response = self.client.get('/', headers={'If-Modified-Since': 'Thu, 01 Jan 2099 00:00:00 GMT'})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Post 5', response.get_data(as_text=True))
+
+    def test_pages_are_cached_until_written(self):
+        """Cached pages skip the page queries and are dropped on writes."""
+        user_id, post_id, tag_id = self.seed_posts(1)
+        self.client.get(f'/posts/{post_id}')
+        self.assertEqual(cache.stats['hits'], 0)
+
+        app.config['MAX_QUERIES_PER_REQUEST'] = 1
+        html = self.client.get(f'/posts/{post_id}').get_data(as_text=True)
+        self.assertIn('Post 0', html)
+        self.assertEqual(cache.stats['hits'], 1)
+        app.config['MAX_QUERIES_PER_REQUEST'] = 10
+
+        self.client.post(f'/tags/{tag_id}/edit', data={'name': 'Renamed', 'shown': [post_id], 'keep': [post_id]})
+        html = self.client.get(f'/posts/{post_id}').get_data(as_text=True)
+        self.assertIn('Renamed', html)
+
+        self.client.post(f'/users/{user_id}/edit', data={'first_name': 'New', 'last_name': 'Name'})
+        html = self.client.get(f'/posts/{post_id}').get_data(as_text=True)
+        self.assertIn('New Name', html)
+
+        self.client.post(f'/posts/{post_id}/edit', data={'title': 'Edited', 'content': 'C'})
+        self.assertIn('Edited', self.client.get('/').get_data(as_text=True))
+        self.assertIn('Edited', self.client.get(f'/tags/{tag_id}').get_data(as_text=True))
+        self.assertIn('Edited', self.client.get(f'/users/{user_id}').get_data(as_text=True))
+
+        self.client.post(f'/posts/{post_id}/delete')
+        self.assertNotIn('Edited', self.client.get('/').get_data(as_text=True))
+        self.assertNotIn('Edited', self.client.get(f'/tags/{tag_id}').get_data(as_text=True))
+
+    def test_cache_stats(self):
+        """Hit and miss counters are exposed as JSON."""
+        self.client.get('/')
+        self.client.get('/')
+        stats = self.client.get('/cache/stats').get_json()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_lru_cache_limits(self):
+        """The LRU backend evicts the oldest entry and expires stale ones."""
+        lru = LRUCache(max_entries=2, ttl=60)
+        lru.set('a', 'A', ['post:1'])
+        lru.set('b', 'B')
+        lru.get('a')
+        lru.set('c', 'C')
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('a'), 'A')
+        self.assertEqual(lru.invalidate(['post:1']), 1)
+        self.assertIsNone(lru.get('a'))
+
+        lru = LRUCache(ttl=-1)
+        lru.set('a', 'A')
+        self.assertIsNone(lru.get('a'))
+
+    def test_redis_cache(self):
+        """The Redis backend stores plain strings and drops entries by dependency."""
+        client = FakeRedis()
+        client.set('other:key', 'kept')
+        redis_cache = RedisCache(client, ttl=60)
+        redis_cache.set('page:/posts/1', '<p>Post</p>', ['post:1', 'user:1'])
+        redis_cache.set('page:/users/1', '<p>User</p>', ['user:1'])
+        self.assertEqual(client.data['blogly:page:/posts/1'], b'<p>Post</p>')
+        self.assertEqual(client.ttls['blogly:dep:post:1'], 60)
+        self.assertEqual(redis_cache.get('page:/posts/1'), '<p>Post</p>')
+        self.assertIsNone(redis_cache.get('page:/missing'))
+
+        self.assertEqual(redis_cache.invalidate(['post:1']), 1)
+        self.assertIsNone(redis_cache.get('page:/posts/1'))
+        self.assertEqual(redis_cache.get('page:/users/1'), '<p>User</p>')
+
+        redis_cache.clear()
+        self.assertIsNone(redis_cache.get('page:/users/1'))
+        self.assertEqual(client.data, {'other:key': b'kept'})
+
+        _, post_id, _ = self.seed_posts(1)
+        backend, cache.backend = cache.backend, redis_cache
+        try:
+            self.client.get(f'/posts/{post_id}')
+            self.assertIn('Post 0', self.client.get(f'/posts/{post_id}').get_data(as_text=True))
+            self.assertEqual(cache.stats['hits'], 1)
+            self.client.post(f'/posts/{post_id}/edit', data={'title': 'Edited', 'content': 'C'})
+            self.assertIn('Edited', self.client.get(f'/posts/{post_id}').get_data(as_text=True))
+        finally:
+            cache.backend = backend
+
+    def test_conditional_get(self):
+        """Pages answer If-None-Match / If-Modified-Since with a 304 until
+        the rows they show change."""
+        user_id, post_id, tag_id = self.seed_posts(1)
+        for url in ['/', f'/posts/{post_id}', f'/users/{user_id}', f'/tags/{tag_id}']:
+            response = self.client.get(url)
+            etag = response.headers['ETag']
+            last_modified = response.headers.get('Last-Modified')
+
+            app.config['MAX_QUERIES_PER_REQUEST'] = 1
+            response = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304, url)
+            self.assertEqual(response.get_data(), b'')
+            if url != '/':
+                response = self.client.get(url, headers={'If-Modified-Since': last_modified})
+                self.assertEqual(response.status_code, 304, url)
+            app.config['MAX_QUERIES_PER_REQUEST'] = 10
+
+        etag = self.client.get(f'/posts/{post_id}').headers['ETag']
+        self.client.post(f'/tags/{tag_id}/edit', data={'name': 'One', 'shown': [post_id]})
+        response = self.client.get(f'/posts/{post_id}', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+        etag = self.client.get(f'/users/{user_id}').headers['ETag']
+        self.client.post(f'/posts/{post_id}/delete')
+        response = self.client.get(f'/users/{user_id}', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_conditional_get_missing_row(self):
+        """Validators for a missing row give a 404."""
+        self.assertEqual(self.client.get('/posts/99').status_code, 404)
+
+    def test_search(self):
+        """Search finds posts by title or content and follows edits/deletes."""
+        with app.app_context():
+            user = User(first_name='Test', last_name='User')
+            db.session.add(user)
+            db.session.commit()
+            user_id = user.id
+        self.client.post(f'/users/{user_id}/posts/new',
+                         data={'title': 'Sourdough starter', 'content': 'Feed it flour daily.'})
+        self.client.post(f'/users/{user_id}/posts/new',
+                         data={'title': 'Bread notes', 'content': 'A sourdough loaf needs time.'})
+
+        html = self.client.get('/search?q=sourdough').get_data(as_text=True)
+        self.assertLess(html.index('Sourdough starter'), html.index('Bread notes'))
+        self.assertIn('Bread notes', self.client.get('/search?q=loaf').get_data(as_text=True))
+        self.assertIn('No posts match', self.client.get('/search?q="OR').get_data(as_text=True))
+
+        with app.app_context():
+            post_id = Post.query.filter_by(title='Bread notes').one().id
+        self.client.post(f'/posts/{post_id}/edit', data={'title': 'Rye notes', 'content': 'Dense.'})
+        self.assertNotIn('Rye notes', self.client.get('/search?q=loaf').get_data(as_text=True))
+        self.assertIn('Rye notes', self.client.get('/search?q=dense').get_data(as_text=True))
+
+        self.client.post(f'/posts/{post_id}/delete')
+        self.assertNotIn('Rye notes', self.client.get('/search?q=dense').get_data(as_text=True))
+
+        self.client.post(f'/users/{user_id}/delete')
+        self.assertIn('No posts match', self.client.get('/search?q=sourdough').get_data(as_text=True))
+
+    def test_bulk_import_export(self):
+        """Import loads rows in batches and is idempotent; export round-trips."""
+        runner = app.test_cli_runner()
+        with tempfile.TemporaryDirectory() as tmp:
+            files = {
+                'users.jsonl': [{'id': 7, 'first_name': 'Ada', 'last_name': 'Lovelace'}],
+                'posts.jsonl': [{'id': i, 'title': f'Note {i}', 'content': 'Engines',
+                                 'user_id': 7, 'created_at': '2024-01-0%dT10:00:00' % i}
+                                for i in range(1, 6)],
+                'tags.jsonl': [{'name': 'math'}, {'name': 'history'}],
+            }
+            files['links.jsonl'] = [{'post_id': i, 'tag': 'math'} for i in range(1, 6)]
+            for name, records in files.items():
+                with open(os.path.join(tmp, name), 'w') as file:
+                    file.writelines(json.dumps(record) + '\n' for record in records)
+
+            for _ in range(2):
+                for kind in ['users', 'posts', 'tags', 'links']:
+                    result = runner.invoke(args=['blogly', 'import', kind,
+                                                 os.path.join(tmp, f'{kind}.jsonl'),
+                                                 '--batch-size', '2'])
+                    self.assertEqual(result.exit_code, 0, result.output)
+
+            with app.app_context():
+                self.assertEqual(User.query.count(), 1)
+                self.assertEqual(Post.query.count(), 5)
+                self.assertEqual(Tag.query.filter_by(name='math').one().posts[0].user_id, 7)
+                self.assertEqual(len(Tag.query.filter_by(name='math').one().posts), 5)
+
+            self.assertIn('Note 3', self.client.get('/search?q=engines').get_data(as_text=True))
+
+            path = os.path.join(tmp, 'out.csv')
+            result = runner.invoke(args=['blogly', 'export', 'posts', '-o', path])
+            self.assertEqual(result.exit_code, 0, result.output)
+            with open(path) as file:
+                lines = file.read().splitlines()
+            self.assertEqual(lines[0], 'id,title,content,created_at,user_id')
+            self.assertEqual(lines[1], '1,Note 1,Engines,2024-01-01T10:00:00,7')
+
+            result = runner.invoke(args=['blogly', 'export', 'links'])
+            self.assertEqual(json.loads(result.output.splitlines()[0]), {'post_id': 1, 'tag': 'math'})
+
+    def test_import_refuses_records_without_ids(self):
+        """User and post records need an id, or a re-run would duplicate them."""
+        runner = app.test_cli_runner()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'users.csv')
+            with open(path, 'w') as file:
+                file.write('id,first_name,last_name\n1,Ada,Lovelace\n,Alan,Turing\n')
+            result = runner.invoke(args=['blogly', 'import', 'users', path])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('users line 3: missing id', result.output)
+        with app.app_context():
+            self.assertEqual(User.query.count(), 0)
+
+    def test_import_changes_cached_page_versions(self):
+        """Pages cached by the web process go stale on import without clearing the cache."""
+        user_id, post_id, tag_id = self.seed_posts(1)
+        urls = ['/', f'/users/{user_id}', f'/posts/{post_id}']
+        for url in urls:
+            self.client.get(url)
+        runner = app.test_cli_runner()
+        with tempfile.TemporaryDirectory() as tmp:
+            files = {
+                'posts.jsonl': [{'id': 100, 'title': 'Imported', 'content': 'Text', 'user_id': user_id}],
+                'tags.jsonl': [{'name': 'Three'}],
+                'links.jsonl': [{'post_id': post_id, 'tag': 'Three'}],
+            }
+            for name, records in files.items():
+                path = os.path.join(tmp, name)
+                with open(path, 'w') as file:
+                    file.writelines(json.dumps(record) + '\n' for record in records)
+                with patch.object(cache, 'clear', side_effect=AssertionError('cache cleared')):
+                    result = runner.invoke(args=['blogly', 'import', name.split('.')[0], path])
+                self.assertEqual(result.exit_code, 0, result.output)
+
+        self.assertIn('Imported', self.client.get('/').get_data(as_text=True))
+        self.assertIn('Imported', self.client.get(f'/users/{user_id}').get_data(as_text=True))
+        self.assertIn('Three', self.client.get(f'/posts/{post_id}').get_data(as_text=True))
+
+    def test_post_counts_follow_writes(self):
+        """post_count on users and tags tracks posts being added, tagged and deleted."""
+        self.client.post('/users/new', data={'first_name': 'Ada', 'last_name': 'L', 'image_url': ''})
+        with app.app_context():
+            user_id = User.query.one().id
+        for title in ['First', 'Second']:
+            self.client.post(f'/users/{user_id}/posts/new', data={'title': title, 'content': 'Text'})
+        with app.app_context():
+            post_ids = [post.id for post in Post.query.order_by(Post.id)]
+        self.client.post('/tags/new', data={'name': 'Math', 'posts': post_ids})
+        with app.app_context():
+            tag_id = Tag.query.one().id
+            self.assertEqual(db.session.get(User, user_id).post_count, 2)
+            self.assertEqual(db.session.get(Tag, tag_id).post_count, 2)
+
+        self.client.post(f'/posts/{post_ids[0]}/delete')
+        with app.app_context():
+            self.assertEqual(db.session.get(User, user_id).post_count, 1)
+            self.assertEqual(db.session.get(Tag, tag_id).post_count, 1)
+        self.client.post(f'/tags/{tag_id}/edit', data={'name': 'Math', 'shown': post_ids[1:]})
+        with app.app_context():
+            self.assertEqual(db.session.get(Tag, tag_id).post_count, 0)
+        self.assertIn('(0)', self.client.get('/tags').get_data(as_text=True))
+
+    def test_writes_move_counters_without_recounting(self):
+        """Writes add their own delta to post_count; only verify recounts."""
+        user_id, post_id, tag_id = self.seed_posts(2)
+        with app.app_context():
+            db.session.get(User, user_id).post_count = 10
+            db.session.get(Tag, tag_id).post_count = 10
+            db.session.commit()
+        self.client.post(f'/users/{user_id}/posts/new', data={'title': 'Third', 'content': 'Text'})
+        self.client.post(f'/tags/{tag_id}/edit', data={'name': 'One', 'shown': [post_id]})
+        with app.app_context():
+            self.assertEqual(db.session.get(User, user_id).post_count, 11)
+            self.assertEqual(db.session.get(Tag, tag_id).post_count, 9)
+            feed.verify()
+            self.assertEqual(db.session.get(User, user_id).post_count, 2)
+            self.assertEqual(db.session.get(Tag, tag_id).post_count, 1)
+
+    def test_profile_save_without_rename_keeps_feed_rows(self):
+        """Saving a user without changing their name leaves their feed rows alone."""
+        user_id, post_id, tag_id = self.seed_posts(1)
+        etag = self.client.get('/').headers['ETag']
+        with app.app_context():
+            updated_at = db.session.get(FeedItem, post_id).updated_at
+        self.client.post(f'/users/{user_id}/edit', data={'first_name': 'User', 'last_name': '0',
+                                                         'image_url': '/static/images/new.png'})
+        with app.app_context():
+            self.assertEqual(db.session.get(FeedItem, post_id).updated_at, updated_at)
+        self.assertEqual(self.client.get('/', headers={'If-None-Match': etag}).status_code, 304)
+
+    def test_homepage_reads_feed(self):
+        """The homepage renders from the feed table, which follows renames and retags."""
+        user_id, post_id, tag_id = self.seed_posts()
+        self.client.post(f'/users/{user_id}/edit', data={'first_name': 'Renamed', 'last_name': 'Author'})
+        self.client.post(f'/tags/{tag_id}/edit', data={'name': 'Uno', 'shown': list(range(post_id, post_id + 5)),
+                                                          'keep': [post_id]})
+
+        app.config['MAX_QUERIES_PER_REQUEST'] = 2
+        html = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Renamed Author', html)
+        self.assertEqual(html.count('Uno'), 1)
+        with app.app_context():
+            item = db.session.get(FeedItem, post_id)
+            self.assertEqual([tag.name for tag in item.tags], ['Uno', 'Two'])
+
+    def test_feed_refresh_upserts_rows(self):
+        """Feed rows are rewritten in place, never deleted and re-inserted."""
+        user_id, post_id, tag_id = self.seed_posts(2)
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with app.app_context():
+            db.session.get(Post, post_id).title = 'Upserted'
+            db.session.flush()
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                feed.refresh_posts([post_id, post_id + 1])
+                feed.refresh_posts([post_id])
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+            db.session.commit()
+            self.assertFalse([sql for sql in statements if sql.startswith('DELETE')])
+            self.assertEqual(db.session.get(FeedItem, post_id).title, 'Upserted')
+            self.assertEqual(FeedItem.query.count(), 2)
+
+    def test_tag_rename_rewrites_feed_tags_in_place(self):
+        """Renaming a tag swaps its name in tags_json without rebuilding feed rows."""
+        user_id, post_id, tag_id = self.seed_posts(3)
+        with app.app_context():
+            db.session.get(FeedItem, post_id).title = 'Left alone'
+            db.session.commit()
+        self.client.post(f'/tags/{tag_id}/edit', data={'name': 'Say "one"'})
+        with app.app_context():
+            item = db.session.get(FeedItem, post_id)
+            self.assertEqual(item.title, 'Left alone')
+            self.assertEqual([tag.name for tag in item.tags], ['Say "one"', 'Two'])
+            self.assertEqual(feed.verify(repair=False), {'users': 0, 'tags': 0, 'feed': 1})
+
+    def test_verify_feed_repairs_drift(self):
+        """verify-feed reports stale counters and feed rows and rewrites them."""
+        user_id, post_id, tag_id = self.seed_posts()
+        with app.app_context():
+            db.session.get(User, user_id).post_count = 7
+            db.session.get(FeedItem, post_id).title = 'Stale'
+            db.session.add(FeedItem(post_id=999, user_id=user_id, created_at=Post.query.first().created_at,
+                                    updated_at=Post.query.first().created_at, title='Gone',
+                                    content='', author_name=''))
+            db.session.commit()
+
+            runner = app.test_cli_runner()
+            result = runner.invoke(args=['blogly', 'verify-feed', '--dry-run'])
+            self.assertIn('users: 1 stale', result.output)
+            self.assertIn('feed: 2 stale', result.output)
+            runner.invoke(args=['blogly', 'verify-feed', '--batch-size', '2'])
+            self.assertEqual(feed.verify(repair=False), {'users': 0, 'tags': 0, 'feed': 0})
+            self.assertEqual(db.session.get(FeedItem, post_id).title, 'Post 0')
+
+    def test_tag_writes_are_set_based(self):
+        """Tagging many posts costs the same number of statements as tagging a few."""
+        self.seed_posts(40)
+        with app.app_context():
+            post_ids = [post.id for post in Post.query.order_by(Post.id)]
+        app.config['MAX_QUERIES_PER_REQUEST'] = 9
+        self.client.post('/tags/new', data={'name': 'Bulk', 'posts': post_ids[:30]})
+        with app.app_context():
+            tag = Tag.query.filter_by(name='Bulk').one()
+            tag_id = tag.id
+            self.assertEqual(tag.post_count, 30)
+
+        app.config['MAX_QUERIES_PER_REQUEST'] = 10
+        self.client.post(f'/tags/{tag_id}/edit', data={
+            'name': 'Bulkier', 'shown': post_ids[:30], 'keep': post_ids[10:30], 'add': post_ids[30:] + [9999]})
+        with app.app_context():
+            tag = db.session.get(Tag, tag_id)
+            self.assertEqual(sorted(post.id for post in tag.posts), post_ids[10:])
+            self.assertEqual(tag.post_count, 30)
+            self.assertEqual(feed.verify(repair=False), {'users': 0, 'tags': 0, 'feed': 0})
+
+    def test_bulk_link_endpoint(self):
+        """/tags/links adds and removes many links in one request."""
+        user_id, post_id, tag_id = self.seed_posts(3)
+        with app.app_context():
+            post_ids = [post.id for post in Post.query.order_by(Post.id)]
+            new_tag = Tag(name='Three')
+            db.session.add(new_tag)
+            db.session.commit()
+            new_tag_id = new_tag.id
+
+        response = self.client.post('/tags/links', json={
+            'add': [{'post_id': pid, 'tag_id': new_tag_id} for pid in post_ids]
+                   + [{'post_id': post_id, 'tag_id': tag_id}],
+            'remove': [{'post_id': pid, 'tag_id': tag_id} for pid in post_ids[1:]]})
+        self.assertEqual(response.get_json(), {'added': 3, 'removed': 2})
+        with app.app_context():
+            self.assertEqual(db.session.get(Tag, new_tag_id).post_count, 3)
+            self.assertEqual(db.session.get(Tag, tag_id).post_count, 1)
+            self.assertEqual(feed.verify(repair=False), {'users': 0, 'tags': 0, 'feed': 0})
+        self.assertIn('Three', self.client.get(f'/posts/{post_ids[-1]}').get_data(as_text=True))
+
+        response = self.client.post('/tags/links', json={'add': [{'post_id': 9999, 'tag_id': tag_id}]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['posts'], [9999])
+        self.assertEqual(self.client.post('/tags/links', json=['bad']).status_code, 400)
+
+    @contextmanager
+    def replica(self):
+        """Route GETs to a separate SQLite database standing in for a replica."""
+        with tempfile.TemporaryDirectory() as tmp:
+            replica = create_engine(f'sqlite:///{tmp}/replica.db')
+            db.metadata.create_all(replica)
+            with app.app_context():
+                db.engines[routing.REPLICA] = replica
+            try:
+                yield replica
+            finally:
+                with app.app_context():
+                    del db.engines[routing.REPLICA]
+                replica.dispose()
+
+    def test_reads_go_to_replica(self):
+        """GETs read from the replica, except for a client that just wrote."""
+        with self.replica() as replica:
+            with replica.begin() as conn:
+                conn.execute(User.__table__.insert(), {'first_name': 'Replica', 'last_name': 'Copy'})
+            self.assertIn('Replica Copy', self.client.get('/users').get_data(as_text=True))
+
+            self.client.post('/users/new', data={'first_name': 'Fresh', 'last_name': 'Write', 'image_url': ''})
+            html = self.client.get('/users').get_data(as_text=True)
+            self.assertIn('Fresh Write', html)
+            self.assertNotIn('Replica Copy', html)
+
+            app.config['READ_YOUR_WRITES_SECONDS'] = 0
+            self.client.post('/users/new', data={'first_name': 'Second', 'last_name': 'Write', 'image_url': ''})
+            self.assertIn('Replica Copy', self.client.get('/users').get_data(as_text=True))
+
+    def test_stale_replica_pages_are_not_served_to_writers(self):
+        """A page another client cached from the lagging replica never reaches
+        the client pinned to the primary."""
+        with self.replica() as replica:
+            with app.app_context():
+                user = User(first_name='Old', last_name='Name')
+                db.session.add(user)
+                db.session.commit()
+                row = {column.name: getattr(user, column.name) for column in User.__table__.c}
+            with replica.begin() as conn:
+                conn.execute(User.__table__.insert(), row)
+
+            writer, reader = self.client, app.test_client()
+            writer.post(f"/users/{row['id']}/edit", data={'first_name': 'New', 'last_name': 'Name'})
+            self.assertIn('Old Name', reader.get(f"/users/{row['id']}").get_data(as_text=True))
+            self.assertIn('New Name', writer.get(f"/users/{row['id']}").get_data(as_text=True))
+            # The reader's stale render is still reused for readers of the replica.
+            self.assertIn('Old Name', reader.get(f"/users/{row['id']}").get_data(as_text=True))
+            self.assertEqual(cache.stats['hits'], 1)
+
+    def test_engine_options_and_pool_stats(self):
+        """Pool settings reach pooled engines; /db/pool reports every engine."""
+        options = routing.engine_options('postgresql:///blogly',
+                                         dict(app.config, DB_STATEMENT_TIMEOUT_MS='2000'))
+        self.assertEqual(options['pool_size'], 5)
+        self.assertEqual(options['connect_args'], {'options': '-c statement_timeout=2000'})
+        self.assertEqual(routing.engine_options('sqlite:///:memory:', app.config), {'pool_pre_ping': True})
+
+        stats = self.client.get('/db/pool').get_json()
+        self.assertEqual(list(stats), ['primary'])
+        self.assertIn('status', stats['primary'])
+
+    def test_api_lists_stream_with_cursors(self):
+        """/api/v1 lists stream sparse fieldsets one keyset page at a time."""
+        self.seed_posts(5)
+        response = self.client.get('/api/v1/users?fields=id,last_name&limit=3')
+        self.assertTrue(response.is_streamed)
+        body = response.get_json()
+        self.assertEqual([user['last_name'] for user in body['data']], ['0', '1', '2'])
+        self.assertEqual(set(body['data'][0]), {'id', 'last_name'})
+
+        body = self.client.get(f"/api/v1/users?fields=last_name&limit=3&after={body['next_after']}").get_json()
+        self.assertEqual(body, {'data': [{'last_name': '3'}, {'last_name': '4'}], 'next_after': None})
+
+        self.assertEqual(self.client.get('/api/v1/users?fields=password').status_code, 400)
+        self.assertEqual(self.client.get('/api/v1/posts?include=comments').status_code, 400)
+        self.assertEqual(self.client.get('/api/v1/tags?limit=0').status_code, 400)
+
+    def test_api_includes_load_per_batch(self):
+        """include= embeds related rows with one query per batch, not per row."""
+        user_id, post_id, tag_id = self.seed_posts(25)
+        app.config['API_BATCH_SIZE'] = 10
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                body = self.client.get('/api/v1/posts?fields=title&include=user,tags'
+                                       '&fields[user]=first_name,last_name&fields[tags]=name').get_json()
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(len(body['data']), 25)
+        self.assertEqual(body['data'][0], {'title': 'Post 0',
+                                           'user': {'first_name': 'User', 'last_name': '0'},
+                                           'tags': [{'name': 'One'}, {'name': 'Two'}]})
+        self.assertEqual(len(statements), 1 + 3 * 2)
+
+        body = self.client.get(f'/api/v1/tags/{tag_id}?include=posts&fields[posts]=id').get_json()
+        self.assertEqual(body['data']['name'], 'One')
+        self.assertEqual(len(body['data']['posts']), 25)
+
+        app.config['API_INCLUDE_LIMIT'] = 10
+        body = self.client.get('/api/v1/tags?fields=post_count&include=posts&fields[posts]=id').get_json()
+        self.assertEqual([tag['post_count'] for tag in body['data']], [25, 25])
+        self.assertEqual([[post['id'] for post in tag['posts']] for tag in body['data']],
+                         [list(range(post_id, post_id + 10))] * 2)
+        self.assertEqual(self.client.get('/api/v1/posts/9999').status_code, 404)
+
+    def test_avatars_are_fetched_once_and_resized(self):
+        """A saved image URL is stored locally as immutable, srcset-ready thumbnails."""
+        from PIL import Image
+        images = {}
+        for path, size in [('/me.png', (1200, 800)), ('/big.png', (3000, 3000))]:
+            images[path] = io.BytesIO()
+            Image.new('RGB', size, 'teal').save(images[path], 'PNG')
+        source = images['/me.png']
+        fetches = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fetches.append(self.path)
+                if self.path == '/redirect':
+                    self.send_response(302)
+                    self.send_header('Location', 'http://169.254.169.254/latest/meta-data/')
+                    self.end_headers()
+                    return
+                if self.path not in images:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.end_headers()
+                self.wfile.write(images[self.path].getvalue())
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_port}/me.png'
+        store = avatars.store
+        try:
+            # Loopback, and redirects to link-local, are refused unless allowed.
+            with self.assertRaises(BlockedAddress):
+                fetch(url, 5, 1000)
+            self.assertEqual(fetches, [])
+            with self.assertRaises(BlockedAddress):
+                fetch(url.replace('/me.png', '/redirect'), 5, 1000, ['127.0.0.0/8'])
+            self.assertEqual(fetches, ['/redirect'])
+            fetches.clear()
+            app.config['AVATAR_FETCH_ALLOWED_NETWORKS'] = ('127.0.0.0/8',)
+
+            with tempfile.TemporaryDirectory() as tmp:
+                avatars.store = LocalStore(tmp)
+                self.client.post('/users/new', data={'first_name': 'Pic', 'last_name': 'User', 'image_url': url})
+                avatars.wait()
+                with app.app_context():
+                    user = User.query.one()
+                    user_id, digest = user.id, user.avatar_digest
+                self.assertIsNotNone(digest)
+
+                html = self.client.get('/users').get_data(as_text=True)
+                self.assertIn(f'/avatars/{digest[:2]}/{digest}-50.jpg 1x', html)
+                self.assertIn(f'/avatars/{digest[:2]}/{digest}-100.jpg 2x', html)
+                response = self.client.get(f'/avatars/{digest[:2]}/{digest}-50.jpg')
+                self.assertIn('immutable', response.headers['Cache-Control'])
+                with Image.open(io.BytesIO(response.data)) as thumbnail:
+                    self.assertEqual(thumbnail.size, (50, 50))
+                self.assertLess(len(response.data), len(source.getvalue()))
+                response.close()
+
+                # Another user with the same image reuses the stored thumbnails.
+                self.client.post('/users/new', data={'first_name': 'Same', 'last_name': 'Pic', 'image_url': url})
+                avatars.wait()
+                self.assertEqual(len(os.listdir(os.path.join(tmp, digest[:2]))), 4)
+
+                # A broken URL keeps hotlinking the original.
+                self.client.post(f'/users/{user_id}/edit', data={
+                    'first_name': 'Pic', 'last_name': 'User', 'image_url': url + '.missing'})
+                avatars.wait()
+                with app.app_context():
+                    self.assertIsNone(db.session.get(User, user_id).avatar_digest)
+                self.assertIn(url + '.missing', self.client.get(f'/users/{user_id}').get_data(as_text=True))
+                self.assertEqual(fetches, ['/me.png', '/me.png', '/me.png.missing'])
+
+                # Images over the pixel cap are refused before decoding.
+                app.config['AVATAR_MAX_PIXELS'] = 4_000_000
+                with self.assertLogs('blogly.avatars', 'WARNING'):
+                    self.client.post(f'/users/{user_id}/edit', data={
+                        'first_name': 'Pic', 'last_name': 'User', 'image_url': url.replace('me', 'big')})
+                    avatars.wait()
+                with app.app_context():
+                    self.assertIsNone(db.session.get(User, user_id).avatar_digest)
+        finally:
+            avatars.store = store
+            server.shutdown()
+            server.server_close()
+
+    def test_migrations_match_models(self):
+        """Running every migration builds exactly the schema the models declare."""
+        migrations = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+        with app.app_context():
+            db.drop_all()
+            upgrade(directory=migrations)
+            with db.engine.connect() as conn:
+                context = MigrationContext.configure(conn, opts={
+                    'include_object': app.extensions['migrate'].configure_args['include_object']})
+                self.assertEqual(compare_metadata(context, db.metadata), [])
+            downgrade(directory=migrations, revision='base')
+            with db.engine.begin() as conn:
+                conn.execute(text('DROP TABLE alembic_version'))
+
+    def test_hot_queries_use_indexes(self):
+        """EXPLAIN every query the read pages run: none scans a whole table."""
+        user_id, post_id, tag_id = self.seed_posts()
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                for url in ['/', f'/posts/{post_id}', f'/users/{user_id}', f'/tags/{tag_id}']:
+                    self.client.get(url)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+            self.assertTrue(statements)
+            with db.engine.connect() as conn:
+                for statement, parameters in statements:
+                    plan = conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters).all()
+                    for row in plan:
+                        detail = row[-1]
+                        if detail.startswith('SCAN') and 'anon' not in detail:
+                            self.assertIn('INDEX', detail, f'{statement}\n{detail}')
+
+    def test_server_timing_header(self):
+        """Each response reports its SQL count, SQL time, render and total time."""
+        _, post_id, _ = self.seed_posts(1)
+        timing = self.client.get(f'/posts/{post_id}').headers['Server-Timing']
+        self.assertRegex(timing, r'^db;dur=[\d.]+;desc="3 queries", '
+                                 r'render;dur=[\d.]+, total;dur=[\d.]+$')
+
+    def test_metrics_endpoint(self):
+        """/metrics serves per-endpoint totals in Prometheus format."""
+        _, post_id, _ = self.seed_posts(1)
+        self.client.get(f'/posts/{post_id}')
+        self.client.get(f'/posts/{post_id}')
+        body = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('blogly_requests_total{endpoint="post_detail",method="GET",status="200"} 2', body)
+        self.assertIn('blogly_db_queries_total{endpoint="post_detail"} 4', body)
+        self.assertIn('blogly_request_duration_seconds_count{endpoint="post_detail"} 2', body)
+        self.assertIn('blogly_render_seconds_total{endpoint="post_detail"}', body)
+
+    def test_streamed_responses_are_measured_when_closed(self):
+        """Queries run while a streamed body is sent count towards its request."""
+        self.seed_posts(25)
+        app.config['API_BATCH_SIZE'] = 10
+        with self.client.get('/api/v1/posts?include=tags') as response:
+            self.assertNotIn('Server-Timing', response.headers)
+            response.get_data()
+        body = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('blogly_db_queries_total{endpoint="api.collection"} 4', body)
+
+        app.config['MAX_QUERIES_PER_REQUEST'] = 3
+        with self.assertRaisesRegex(AssertionError, r'api.collection ran 4 SQL statements'):
+            with self.client.get('/api/v1/posts?include=tags') as response:
+                response.get_data()
+
+    def test_slow_query_log(self):
+        """Statements over SLOW_QUERY_MS are logged, at the sampling rate."""
+        app.config['SLOW_QUERY_MS'] = 0
+        app.config['SLOW_QUERY_SAMPLE_RATE'] = 1.0
+        with self.assertLogs('blogly.slow_query', 'WARNING') as logs:
+            self.client.get('/users')
+        self.assertIn('users_list: SELECT', logs.output[0])
+
+        app.config['SLOW_QUERY_SAMPLE_RATE'] = 0.0
+        with self.assertNoLogs('blogly.slow_query', 'WARNING'):
+            self.client.get('/users')
+
+    def test_benchmark_harness(self):
+        """The load test seeds data, drives every route and flags regressions."""
+        app.config['MAX_QUERIES_PER_REQUEST'] = None
+        with app.app_context():
+            data = bench.seed(users=5, posts_per_user=2, tags=3, tags_per_post=2, disposable=5)
+            traffic = bench.generate_traffic(data, 300)
+        samples, wall_time = bench.run(traffic)
+        report = bench.summarize(samples, wall_time)
+
+        self.assertEqual(report['requests'], 300)
+        self.assertGreater(report['throughput_rps'], 0)
+        self.assertIn('post_detail', report['routes'])
+        self.assertIn('tags_edit', report['routes'])
+        self.assertEqual(sum(stats['errors'] for stats in report['routes'].values()), 0)
+
+        self.assertEqual(bench.regressions(report, report), [])
+        baseline = json.loads(json.dumps(report))
+        baseline['routes']['root']['queries_per_request'] -= 1
+        baseline['routes']['post_detail']['p95_ms'] /= 10
+        problems = bench.regressions(report, baseline, tolerance=0.5)
+        self.assertEqual(len(problems), 2)
+
 
 if __name__ == '__main__':
     unittest.main()